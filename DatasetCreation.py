@@ -1,7 +1,12 @@
-import re
+from array import array
+import argparse
+import multiprocessing
+from types import SimpleNamespace
 from convokit import Corpus, download
 import json
 
+from lexicon import get_matcher
+
 # Method definitions
 def load_dataset_dynamic(corpus, start_index, end_index):
     return Corpus(
@@ -17,79 +22,82 @@ def load_dataset_to_memory(corpus_path):
         backend="mem"
     )
 
-def get_target_ids(corpus):
-    target_ids = []
-    
-    othering_terms = [
-        # Dehumanizing terms (animals, pests, disease metaphors)
-        "animal", "beast", "savage", "barbaric", "subhuman", "primitive",
-        "parasite", "vermin", "rat", "cockroach", "monster", "brute",
-        "ape", "gorilla", "monkey", "dog", "pig", "swine", "goat",
-        "bug", "leech", "tick", "lice", "maggot", "worm",
-        "cancer", "tumor", "virus", "plague", "infection", "disease",
-
-        # Moral judgment / worthlessness
-        "scum", "trash", "filth", "worthless", "inferior", "degenerate",
-        "lowlife", "unworthy", "unclean", "impure", "corrupt", "dirty",
-        "disgusting", "vile", "evil", "wicked", "sinful", "cursed",
-        "burden", "freeloader", "sponger",
-
-        # Threatening / dangerous
-        "dangerous", "violent", "aggressive", "hostile", "criminal", "thug",
-        "deviant", "radical", "extremist", "fundamentalist", "terrorist",
-        "predator", "rapist", "gangster", "invader", "occupier", "conqueror",
-        "infiltrator", "threat",
-
-        # Exclusion / separation
-        "outsider", "intruder", "alien", "stranger", "foreigner", "enemy",
-        "unwelcome", "illegal", "unwanted", "expat", "outcast", "undesirable",
-        "colonizer", "settler",
-
-        # Diminishing / infantilizing
-        "ignorant", "backward", "naive", "uncivilized", "helpless",
-        "weak", "stupid", "lazy", "immature", "childlike", "silly",
-        "emotional", "hysterical", "irrational", "clueless",
-        "brainwashed", "sheep", "puppet", "follower",
-
-        # Religion & secular identities
-        "atheists", "non-believers", "secular people",
-        "buddhists", "buddhist people",
-        "hindus", "hindu people",
-        "christians", "christian people", "catholics", "protestants",
-        "mormons", "evangelicals", "pagans", "satanists",
-        "muslims", "islamic people", "islamists", "muzzies", "ragheads",
-        "jews", "jewish people", "zionists", "orthodox jews",
-
-        # Migration / nationality
-        "immigrants", "migrants", "foreigners", "outsiders", "refugees",
-        "asylum seekers", "expats", "nationals", "illegal aliens", "illegals",
-        "invaders", "colonizers", "settlers",
-
-        # Gender & women
-        "women", "woman", "girl", "girls", "females", "ladies", "wives", "mothers",
-        "bitches", "sluts", "whores", "feminists", "feminazis",
-
-        # LGBTQ+
-        "lgbtq", "gay", "gays", "lesbian", "lesbians",
-        "bisexual", "transgender", "trans", "tranny", "trannies",
-        "queer", "queers", "dyke", "dykes", "faggot", "faggots",
-        "non-binary", "drag queens", "drag kings"
-    ]
-    
-    # Pre-compile regex patterns
-    patterns = [
-        re.compile(r"(?i)(?<!\w)" + re.escape(term) + r"(?!\w)")
-        for term in othering_terms
-    ]
+def iter_target_ids(corpus, language="en"):
+    # Compiled lexicon, shared with extract_comments.py
+    matcher = get_matcher(language)
 
     for utt in corpus.iter_utterances():
-        if any(p.search(utt.text) for p in patterns):
-            target_ids.append(utt.id)
+        if matcher.search(utt.text):
+            yield utt.id
+
 
-    return target_ids
+def get_target_ids(corpus, language="en"):
+    return list(iter_target_ids(corpus, language))
 
     
-def get_id_chain(corpus, target_id):
+class ReplyTreeIndex:
+    """
+    Parent pointers and depths of all utterances of a corpus, built once,
+    so reply chains don't have to be walked through the corpus per target.
+    Chains are rebuilt from the parent pointers when asked for, so memory
+    stays linear in the number of utterances however deep the threads are.
+    """
+
+    def __init__(self, corpus=None, parents=None):
+        """
+        Build from a corpus, or from a {utterance_id: reply_to} dict.
+        """
+        if parents is None:
+            parents = {utt.id: utt.reply_to for utt in corpus.iter_utterances()}
+
+        self.ids = list(parents.keys())
+        self.position = {utt_id: idx for idx, utt_id in enumerate(self.ids)}
+        reply_tos = list(parents.values())
+
+        # -1 marks a root, or a reply to an utterance outside the corpus.
+        self.parent = array("l", [-1] * len(self.ids))
+        for idx, reply_to in enumerate(reply_tos):
+            if reply_to is not None and reply_to in self.position:
+                self.parent[idx] = self.position[reply_to]
+
+        # 0 for a root, every node is walked up to once.
+        self.depth = array("l", [-1] * len(self.ids))
+        for idx in range(len(self.ids)):
+            self._set_depth(idx)
+
+    def _set_depth(self, idx):
+        # walk up to the first ancestor with a known depth.
+        start = idx
+        path = []
+        on_path = set()
+        while idx != -1 and self.depth[idx] == -1:
+            if idx in on_path:  # reply_to cycle, make this node a root.
+                self.parent[idx] = -1
+                return self._set_depth(start)
+            path.append(idx)
+            on_path.add(idx)
+            idx = self.parent[idx]
+        depth = self.depth[idx] if idx != -1 else -1
+        for node in reversed(path):
+            depth += 1
+            self.depth[node] = depth
+
+    def root_path(self, utt_id):
+        """
+        Ids from the root down to utt_id.
+        """
+        idx = self.position[utt_id]
+        path = [None] * (self.depth[idx] + 1)
+        for i in range(len(path) - 1, -1, -1):
+            path[i] = self.ids[idx]
+            idx = self.parent[idx]
+        return tuple(path)
+
+
+def get_id_chain(corpus, target_id, reply_index=None):
+    if reply_index is not None:
+        return [corpus.get_utterance(i) for i in reply_index.root_path(target_id)]
+
     chain = []
     utt = corpus.get_utterance(target_id)
     while utt is not None:
@@ -100,41 +108,317 @@ def get_id_chain(corpus, target_id):
     chain = chain[::-1]
     return chain
 
-    
-def export_comments_to_json(corpus, target_ids, filepath):
-    results = []
-    
+
+def export_comments_to_json(corpus, target_ids, filepath, reply_index=None):
+    """
+    Export the targets with their reply chains. Each chain is a list of ids
+    into one shared utterance table, so chain text is stored once no matter
+    how many targets share it.
+    """
+    if reply_index is None:
+        reply_index = ReplyTreeIndex(corpus)
+
+    utterances = {}
+    records = []
+
     for target_id in target_ids:
         utt = corpus.get_utterance(target_id)
-        id_chain = get_id_chain(corpus, target_id)
+        chain_ids = reply_index.root_path(target_id)
+
+        for chain_id in chain_ids:
+            if chain_id not in utterances:
+                u = corpus.get_utterance(chain_id)
+                utterances[chain_id] = {
+                    "text": u.text,
+                    "reply_to": u.reply_to,
+                    "timestamp": getattr(u, "timestamp", None)
+                }
 
         record = {
             "id": utt.id,
             "text": utt.text,
             "timestamp": getattr(utt, "timestamp", None),
             "conversation_id": getattr(utt, "conversation_id", None),
-            "comment_chain": [
-                {
-                    "id": u.id,
-                    "text": u.text,
-                    "reply_to": u.reply_to,
-                    "timestamp": getattr(u, "timestamp", None)
-                }
-                for u in id_chain
-            ]
+            "comment_chain": list(chain_ids)
         }
 
-        results.append(record)
-        
+        records.append(record)
+
+    results = {"utterances": utterances, "records": records}
     with open(filepath, "w") as f:
         json.dump(results, f, indent=2)
 
     return results
 
             
+def stream_comments_to_json(
+    corpus, target_ids, filepath, reply_index=None, output_format="jsonl"
+):
+    """
+    Write the targets as they come in (target_ids can be the
+    iter_target_ids() generator), so memory doesn't grow with the hits.
+    output_format:
+        - "jsonl": one line per record, each chain utterance is written
+          once as an {"type": "utterance"} line before the first record
+          that references it.
+        - "dataset": one json object {id: {"text": ...}} as read by
+          Annotate.load_data.
+    Returns the number of records written.
+    """
+    if output_format not in ("jsonl", "dataset"):
+        raise ValueError(f"Unknown output format: {output_format}")
+    if output_format == "jsonl" and reply_index is None:
+        reply_index = ReplyTreeIndex(corpus)
+
+    written_utterances = set()
+    count = 0
+
+    with open(filepath, "w") as f:
+        if output_format == "dataset":
+            f.write("{")
+
+        for target_id in target_ids:
+            utt = corpus.get_utterance(target_id)
+
+            if output_format == "dataset":
+                separator = "," if count > 0 else ""
+                f.write(
+                    f"{separator}\n  {json.dumps(utt.id)}: "
+                    + json.dumps({"text": utt.text})
+                )
+                count += 1
+                continue
+
+            chain_ids = reply_index.root_path(target_id)
+            for chain_id in chain_ids:
+                if chain_id not in written_utterances:
+                    u = corpus.get_utterance(chain_id)
+                    line = {
+                        "type": "utterance",
+                        "id": u.id,
+                        "text": u.text,
+                        "reply_to": u.reply_to,
+                        "timestamp": getattr(u, "timestamp", None)
+                    }
+                    f.write(json.dumps(line) + "\n")
+                    written_utterances.add(chain_id)
+
+            record = {
+                "type": "record",
+                "id": utt.id,
+                "text": utt.text,
+                "timestamp": getattr(utt, "timestamp", None),
+                "conversation_id": getattr(utt, "conversation_id", None),
+                "comment_chain": list(chain_ids)
+            }
+            f.write(json.dumps(record) + "\n")
+            count += 1
+
+        if output_format == "dataset":
+            f.write("\n}\n")
+
+    return count
+
+
+def load_comments_jsonl(filepath):
+    """
+    Read a jsonl export back into (utterances, records), the same shape
+    export_comments_to_json returns.
+    """
+    utterances = {}
+    records = []
+    with open(filepath, "r") as f:
+        for line in f:
+            entry = json.loads(line)
+            entry_type = entry.pop("type")
+            if entry_type == "utterance":
+                utterances[entry.pop("id")] = entry
+            else:
+                records.append(entry)
+    return {"utterances": utterances, "records": records}
+
+            
+class UtteranceTable:
+    """
+    Stand-in for a corpus that only holds the utterances fetched
+    from the windows, enough for the exporters.
+    """
+
+    def __init__(self, utterances):
+        self.utterances = utterances
+
+    def get_utterance(self, utt_id):
+        return SimpleNamespace(id=utt_id, **self.utterances[utt_id])
+
+
+def load_window(corpus_path, start_index, end_index):
+    """
+    Utterances start_index up to, not including, end_index. convokit's
+    utterance_end_index is inclusive, so windows that share an end and a
+    start would overlap by one utterance.
+    """
+    return Corpus(
+        filename=corpus_path,
+        backend="mem",
+        utterance_start_index=start_index,
+        utterance_end_index=end_index - 1
+    )
+
+
+def scan_window(job):
+    """
+    Pool worker: find the targets of one utterance window and
+    return the reply_to of every utterance in it.
+    """
+    corpus_path, start_index, end_index, language = job
+    corpus = load_window(corpus_path, start_index, end_index)
+    parents = {utt.id: utt.reply_to for utt in corpus.iter_utterances()}
+    return {
+        "bounds": (start_index, end_index),
+        "targets": get_target_ids(corpus, language),
+        "parents": parents,
+    }
+
+
+def fetch_window(job):
+    """
+    Pool worker: get the utterances with the given ids from one window.
+    """
+    corpus_path, start_index, end_index, utt_ids = job
+    corpus = load_window(corpus_path, start_index, end_index)
+    utterances = {}
+    for utt_id in utt_ids:
+        utt = corpus.get_utterance(utt_id)
+        utterances[utt_id] = {
+            "text": utt.text,
+            "reply_to": utt.reply_to,
+            "timestamp": getattr(utt, "timestamp", None),
+            "conversation_id": getattr(utt, "conversation_id", None)
+        }
+    return utterances
+
+
+def scan_corpus_parallel(
+    corpus_name,
+    filepath,
+    start_index=0,
+    end_index=None,
+    window_size=100000,
+    workers=4,
+    language="en",
+    output_format="jsonl"
+):
+    """
+    Scan a corpus in utterance windows on a process pool and export the
+    targets with their chains. Each worker only holds one window.
+
+    Pass 1 collects the targets and the reply_to of every utterance, so
+    chains are resolved across window boundaries. Pass 2 loads again only
+    the windows holding chain utterances and fetches just those. Windows
+    are [start, end) and end_index is exclusive. With no end_index,
+    windows are scanned until one comes back empty.
+
+    Note that convokit reads utterances.jsonl from the top for every
+    window and skips to its start, so N windows are N passes over the
+    file. Windows save memory and spread the parsing over the workers,
+    they don't save reading.
+    """
+    corpus_path = download(corpus_name)
+
+    target_ids = []
+    parents = {}
+    window_of = {}  # utterance id -> (start, end) of its window.
+
+    with multiprocessing.Pool(workers) as pool:
+        # --- pass 1: targets and reply structure ---
+        next_start = start_index
+        finished = False
+        while not finished:
+            jobs = []
+            while len(jobs) < workers:
+                if end_index is not None and next_start >= end_index:
+                    break
+                window_end = next_start + window_size
+                if end_index is not None:
+                    window_end = min(window_end, end_index)
+                jobs.append((corpus_path, next_start, window_end, language))
+                next_start = window_end
+            if not jobs:
+                break
+
+            for window in pool.map(scan_window, jobs):
+                if not window["parents"]:
+                    finished = True
+                target_ids.extend(window["targets"])
+                parents.update(window["parents"])
+                for utt_id in window["parents"]:
+                    window_of[utt_id] = window["bounds"]
+
+            print(f"Scanned {len(parents):,} utterances, {len(target_ids):,} targets.")
+
+        # --- pass 2: fetch the chain utterances window by window ---
+        reply_index = ReplyTreeIndex(parents=parents)
+        needed = {}
+        for target_id in target_ids:
+            for chain_id in reply_index.root_path(target_id):
+                needed.setdefault(window_of[chain_id], set()).add(chain_id)
+
+        fetch_jobs = [
+            (corpus_path, start, end, sorted(utt_ids))
+            for (start, end), utt_ids in sorted(needed.items())
+        ]
+        utterances = {}
+        for fetched in pool.imap_unordered(fetch_window, fetch_jobs):
+            utterances.update(fetched)
+
+    table = UtteranceTable(utterances)
+    return stream_comments_to_json(
+        table, target_ids, filepath, reply_index, output_format
+    )
+
+            
 if __name__ == "__main__":
-    corpus = load_dataset_dynamic("reddit-corpus-small", 200, 1000)
-    target_ids = get_target_ids(corpus)
-    export_comments_to_json(corpus, target_ids, "othering_comments.json")
-    print("Exported JSON with", len(target_ids), "records.")
-        
+    parser = argparse.ArgumentParser(
+        description="Find othering targets in a convokit corpus and export their chains."
+    )
+    parser.add_argument("--corpus", type=str, default="reddit-corpus-small")
+    parser.add_argument("--start", type=int, default=200, help="First utterance.")
+    parser.add_argument(
+        "--end",
+        type=int,
+        default=1000,
+        help="Last utterance (inclusive, like convokit), -1 scans to the end."
+    )
+    parser.add_argument(
+        "--window_size", type=int, default=100000, help="Utterances per worker."
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--language", type=str, default="en")
+    parser.add_argument(
+        "--format", choices=["jsonl", "dataset"], default="jsonl"
+    )
+    parser.add_argument("--out", type=str, default="othering_comments.jsonl")
+    args = parser.parse_args()
+
+    if args.workers > 1 or args.end == -1:
+        count = scan_corpus_parallel(
+            args.corpus,
+            args.out,
+            start_index=args.start,
+            end_index=None if args.end == -1 else args.end + 1,
+            window_size=args.window_size,
+            workers=args.workers,
+            language=args.language,
+            output_format=args.format
+        )
+    else:
+        corpus = load_dataset_dynamic(args.corpus, args.start, args.end)
+        reply_index = ReplyTreeIndex(corpus)
+        count = stream_comments_to_json(
+            corpus,
+            iter_target_ids(corpus, args.language),
+            args.out,
+            reply_index,
+            args.format
+        )
+    print("Exported", count, "records to", args.out)
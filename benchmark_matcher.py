@@ -0,0 +1,91 @@
+import argparse
+import json
+import re
+import time
+
+from lexicon import LexiconMatcher, get_languages, load_terms
+
+"""
+Benchmark the single-pass LexiconMatcher against the per-term regex loop
+that extract_comments.py used before. Reports comments/sec for both.
+"""
+
+
+def load_texts(path: str) -> list[str]:
+    """
+    Load comment bodies from a dataset json ({id: {"text": ...}}) or a
+    Reddit jsonl dump (one object with a "body" per line).
+    """
+    if path.endswith(".jsonl"):
+        with open(path, "r") as f:
+            return [json.loads(line).get("body", "") for line in f if line.strip()]
+
+    with open(path, "r") as f:
+        data = json.load(f)
+    return [doc["text"] for doc in data.values()]
+
+
+def legacy_matcher(terms: list[str]):
+    """
+    The old approach: substring scan for multi-word terms
+    plus one compiled regex per single-word term.
+    """
+    single_terms = [t for t in terms if " " not in t]
+    multi_terms = [t for t in terms if " " in t]
+    single_patterns = [
+        re.compile(rf"(?i)(?<!\w){re.escape(t)}(?!\w)") for t in single_terms
+    ]
+
+    def search(body: str) -> bool:
+        return any(term in body for term in multi_terms) or any(
+            p.search(body) for p in single_patterns
+        )
+
+    return search
+
+
+def time_matcher(search, texts: list[str]) -> tuple[float, int]:
+    """
+    Run the matcher over all texts, return (comments/sec, number of hits).
+    """
+    start = time.perf_counter()
+    hits = 0
+    for text in texts:
+        if search(text.lower()):
+            hits += 1
+    elapsed = time.perf_counter() - start
+    return len(texts) / elapsed, hits
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the lexicon matcher.")
+    parser.add_argument(
+        "--data",
+        type=str,
+        default="data/15k.json",
+        help="Dataset json or Reddit jsonl file with the comments to match.",
+    )
+    parser.add_argument(
+        "--language", choices=get_languages(), default="en", help="Lexicon to use."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Number of times to repeat the data."
+    )
+    args = parser.parse_args()
+
+    texts = load_texts(args.data) * args.repeat
+    terms = load_terms(args.language)
+
+    matcher = LexiconMatcher(terms)
+    print(f"Matching {len(texts):,} comments against {len(matcher.terms)} terms")
+
+    legacy_rate, legacy_hits = time_matcher(legacy_matcher(terms), texts)
+    print(f"per-term loop:       {legacy_rate:>12,.0f} comments/sec ({legacy_hits:,} hits)")
+
+    search_rate, search_hits = time_matcher(matcher.search, texts)
+    print(f"LexiconMatcher:      {search_rate:>12,.0f} comments/sec ({search_hits:,} hits)")
+
+    find_rate, _ = time_matcher(matcher.find_terms, texts)
+    print(f"  with term report:  {find_rate:>12,.0f} comments/sec")
+
+    print(f"speedup: {search_rate / legacy_rate:.1f}x")
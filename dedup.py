@@ -0,0 +1,337 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+
+from extract_comments import read_comments
+
+"""
+Remove exact and near-duplicate comments (copypastas, bot replies, quoted
+repeats) from a dataset before it is annotated, and fan the annotation
+results back out to the duplicates afterwards.
+
+Exact duplicates share the hash of their normalized text. Near-duplicates
+are found with MinHash signatures (one permutation hashing) and LSH
+banding, and confirmed with the exact Jaccard similarity of their shingles.
+Quoted lines stay in the text, so replies that quote different comments
+are never merged, and docs with too few words left after normalizing
+(url-only comments, "+1") are never treated as duplicates.
+"""
+
+URL_PATTERN = re.compile(r"https?://\S+|www\.\S+")
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+MAX_HASH = 2**64 - 1
+
+
+def normalize_text(text: str) -> str:
+    """
+    Lower case, drop urls, and keep only the words. Quoted lines are kept
+    without their "> " marker.
+    """
+    text = URL_PATTERN.sub(" ", text.lower())
+    return NON_WORD_PATTERN.sub(" ", text).strip()
+
+
+def hash64(text: str) -> int:
+    """
+    Stable 64 bit hash, the same in every process.
+    """
+    return int.from_bytes(
+        hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def get_shingles(normalized: str, shingle_size: int = 3) -> set[str]:
+    """
+    Word n-grams of a normalized text. Texts shorter than
+    shingle_size words are one shingle.
+    """
+    words = normalized.split()
+    if len(words) <= shingle_size:
+        return {normalized}
+    return {
+        " ".join(words[i : i + shingle_size])
+        for i in range(len(words) - shingle_size + 1)
+    }
+
+
+def get_signature(shingles: set[str], num_hashes: int) -> list[int]:
+    """
+    MinHash signature with one permutation hashing: each shingle is hashed
+    once into one of num_hashes bins and every bin keeps its minimum.
+    Empty bins borrow the value of the next filled bin, so similar texts
+    still agree on them.
+    """
+    signature = [MAX_HASH] * num_hashes
+    for shingle in shingles:
+        value = hash64(shingle)
+        bin_idx = value % num_hashes
+        value //= num_hashes
+        if value < signature[bin_idx]:
+            signature[bin_idx] = value
+
+    # walk right to left twice, so bins at the end also see the
+    # filled bins at the start.
+    densified = list(signature)
+    next_value = None
+    distance = 0
+    for step in range(2 * num_hashes):
+        i = num_hashes - 1 - step % num_hashes
+        if signature[i] != MAX_HASH:
+            next_value, distance = signature[i], 0
+        elif next_value is not None:
+            distance += 1
+            densified[i] = (next_value * 0x9E3779B97F4A7C15 + distance) & MAX_HASH
+    return densified
+
+
+def jaccard(a: set, b: set) -> float:
+    """
+    Jaccard similarity of two sets.
+    """
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class UnionFind:
+    """
+    Class to group doc ids into duplicate clusters.
+    The root of a cluster is always its earliest doc.
+    """
+
+    def __init__(self, ids: list[str]):
+        self.order = {doc_id: i for i, doc_id in enumerate(ids)}
+        self.parent = {doc_id: doc_id for doc_id in ids}
+
+    def find(self, doc_id: str) -> str:
+        root = doc_id
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[doc_id] != root:  # path compression.
+            self.parent[doc_id], doc_id = root, self.parent[doc_id]
+        return root
+
+    def union(self, a: str, b: str):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return
+        if self.order[root_b] < self.order[root_a]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+
+
+def find_duplicates(
+    docs: dict,
+    threshold: float = 0.8,
+    num_hashes: int = 64,
+    bands: int = 16,
+    shingle_size: int = 3,
+    min_words: int = 3,
+) -> dict[str, list[str]]:
+    """
+    Group the docs into exact and near-duplicate clusters. Docs with fewer
+    than min_words words after normalizing are left out of all clusters.
+    returns
+        - dict: {representative_id: [duplicate_id, ...]}, only for
+          representatives that have duplicates. The representative is the
+          first doc of its cluster in dataset order.
+    """
+    if num_hashes % bands != 0:
+        raise ValueError("num_hashes must be a multiple of bands.")
+    rows = num_hashes // bands
+
+    ids = list(docs.keys())
+    clusters = UnionFind(ids)
+
+    # --- exact duplicates ---
+    first_with_hash = {}
+    normalized = {}
+    for doc_id in ids:
+        normalized[doc_id] = normalize_text(docs[doc_id]["text"])
+        if len(normalized[doc_id].split()) < min_words:
+            continue
+        text_hash = hash64(normalized[doc_id])
+        if text_hash in first_with_hash:
+            clusters.union(first_with_hash[text_hash], doc_id)
+        else:
+            first_with_hash[text_hash] = doc_id
+
+    # --- near duplicates, only between the unique texts ---
+    unique_ids = list(first_with_hash.values())
+    shingles = {
+        doc_id: get_shingles(normalized[doc_id], shingle_size)
+        for doc_id in unique_ids
+    }
+    buckets = {}
+    for doc_id in unique_ids:
+        signature = get_signature(shingles[doc_id], num_hashes)
+        for band in range(bands):
+            key = (band, tuple(signature[band * rows : (band + 1) * rows]))
+            buckets.setdefault(key, []).append(doc_id)
+
+    checked = set()
+    for bucket in buckets.values():
+        for i in range(1, len(bucket)):
+            for j in range(i):
+                pair = (bucket[j], bucket[i])
+                if pair in checked:
+                    continue
+                checked.add(pair)
+                if jaccard(shingles[pair[0]], shingles[pair[1]]) >= threshold:
+                    clusters.union(*pair)
+
+    duplicates = {}
+    for doc_id in ids:
+        root = clusters.find(doc_id)
+        if root != doc_id:
+            duplicates.setdefault(root, []).append(doc_id)
+    return duplicates
+
+
+def remove_duplicates(docs: dict, duplicates: dict[str, list[str]]) -> dict:
+    """
+    Keep only the representatives of the duplicate clusters.
+    """
+    duplicate_ids = {dup_id for dup_ids in duplicates.values() for dup_id in dup_ids}
+    return {
+        doc_id: doc for doc_id, doc in docs.items() if doc_id not in duplicate_ids
+    }
+
+
+def expand_results(results: dict, duplicates: dict[str, list[str]], docs: dict) -> dict:
+    """
+    Copy the annotation of each representative to its duplicates.
+    results is an Annotate output ({"data": {id: doc}, ...}), docs is the
+    full dataset so every duplicate keeps its own text.
+    """
+    expanded = dict(results)
+    expanded["data"] = dict(results["data"])
+    for representative_id, dup_ids in duplicates.items():
+        if representative_id not in results["data"]:
+            continue
+        annotation = results["data"][representative_id].get("annotation")
+        for dup_id in dup_ids:
+            expanded["data"][dup_id] = {
+                **docs[dup_id],
+                "annotation": annotation,
+                "duplicate_of": representative_id,
+            }
+    return expanded
+
+
+def load_docs(path: str) -> dict:
+    """
+    Load a dataset json ({id: {"text": ...}}) or an extract_comments.py
+    output (.jsonl or .jsonl.zst) as a dataset.
+    """
+    if path.endswith(".jsonl") or path.endswith(".jsonl.zst"):
+        return {
+            comment["id"]: {"text": comment["body"]} for comment in read_comments(path)
+        }
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_json(data: dict, path: str):
+    """
+    Save the data to a json file, creating the directory if needed.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Remove duplicate comments before annotation."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    dedup_parser = subparsers.add_parser(
+        "dedup", help="Write a dataset without duplicates and the duplicate mapping."
+    )
+    dedup_parser.add_argument(
+        "--dataset",
+        type=str,
+        required=True,
+        help="Dataset json or extract_comments.py output to deduplicate.",
+    )
+    dedup_parser.add_argument(
+        "--out", type=str, required=True, help="Path of the deduplicated dataset."
+    )
+    dedup_parser.add_argument(
+        "--mapping",
+        type=str,
+        required=True,
+        help="Path of the {representative: [duplicates]} mapping.",
+    )
+    dedup_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.8,
+        help="Jaccard similarity of the shingles for near-duplicates.",
+    )
+    dedup_parser.add_argument(
+        "--num_hashes", type=int, default=64, help="MinHash signature length."
+    )
+    dedup_parser.add_argument(
+        "--bands", type=int, default=16, help="Number of LSH bands."
+    )
+    dedup_parser.add_argument(
+        "--shingle_size", type=int, default=3, help="Words per shingle."
+    )
+    dedup_parser.add_argument(
+        "--min_words",
+        type=int,
+        default=3,
+        help="Docs with fewer words after normalizing are never duplicates.",
+    )
+
+    expand_parser = subparsers.add_parser(
+        "expand", help="Copy the annotations of representatives to their duplicates."
+    )
+    expand_parser.add_argument(
+        "--results", type=str, required=True, help="Annotation results json."
+    )
+    expand_parser.add_argument(
+        "--mapping", type=str, required=True, help="Mapping written by dedup."
+    )
+    expand_parser.add_argument(
+        "--dataset", type=str, required=True, help="The full dataset before dedup."
+    )
+    expand_parser.add_argument(
+        "--out", type=str, required=True, help="Path of the expanded results."
+    )
+    args = parser.parse_args()
+
+    if args.command == "dedup":
+        docs = load_docs(args.dataset)
+        duplicates = find_duplicates(
+            docs,
+            threshold=args.threshold,
+            num_hashes=args.num_hashes,
+            bands=args.bands,
+            shingle_size=args.shingle_size,
+            min_words=args.min_words,
+        )
+        unique_docs = remove_duplicates(docs, duplicates)
+        save_json(unique_docs, args.out)
+        save_json(duplicates, args.mapping)
+        print(
+            f"Kept {len(unique_docs):,} of {len(docs):,} docs, "
+            f"{len(docs) - len(unique_docs):,} duplicates in {len(duplicates):,} clusters."
+        )
+
+    elif args.command == "expand":
+        with open(args.results, "r") as f:
+            results = json.load(f)
+        with open(args.mapping, "r") as f:
+            duplicates = json.load(f)
+        expanded = expand_results(results, duplicates, load_docs(args.dataset))
+        save_json(expanded, args.out)
+        print(f"Expanded {len(results['data']):,} results to {len(expanded['data']):,}.")
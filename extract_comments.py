@@ -1,466 +1,790 @@
+import argparse
+import glob
+import hashlib
+import io
 import json
+import multiprocessing
+import os
 import re
+import time
 import zstandard as zstd
+from collections import Counter
 
-othering_terms = [
-    # Dehumanizing terms (animals, pests, disease metaphors)
-    "animal",
-    "beast",
-    "savage",
-    "barbaric",
-    "subhuman",
-    "primitive",
-    "parasite",
-    "vermin",
-    "rat",
-    "cockroach",
-    "monster",
-    "brute",
-    "ape",
-    "gorilla",
-    "monkey",
-    "dog",
-    "pig",
-    "swine",
-    "goat",
-    "bug",
-    "leech",
-    "tick",
-    "lice",
-    "maggot",
-    "worm",
-    "cancer",
-    "tumor",
-    "virus",
-    "plague",
-    "infection",
-    "disease",
-    # Moral judgment / worthlessness
-    "scum",
-    "trash",
-    "filth",
-    "worthless",
-    "inferior",
-    "degenerate",
-    "lowlife",
-    "unworthy",
-    "unclean",
-    "impure",
-    "corrupt",
-    "dirty",
-    "disgusting",
-    "vile",
-    "evil",
-    "wicked",
-    "sinful",
-    "cursed",
-    "burden",
-    "freeloader",
-    "sponger",
-    # Threatening / dangerous
-    "dangerous",
-    "violent",
-    "aggressive",
-    "hostile",
-    "criminal",
-    "thug",
-    "deviant",
-    "radical",
-    "extremist",
-    "fundamentalist",
-    "terrorist",
-    "predator",
-    "rapist",
-    "gangster",
-    "invader",
-    "occupier",
-    "conqueror",
-    "infiltrator",
-    "threat",
-    # Exclusion / separation
-    "outsider",
-    "intruder",
-    "alien",
-    "stranger",
-    "foreigner",
-    "enemy",
-    "unwelcome",
-    "illegal",
-    "unwanted",
-    "expat",
-    "outcast",
-    "undesirable",
-    "colonizer",
-    "settler",
-    # Diminishing / infantilizing
-    "ignorant",
-    "backward",
-    "naive",
-    "uncivilized",
-    "helpless",
-    "weak",
-    "stupid",
-    "lazy",
-    "immature",
-    "childlike",
-    "silly",
-    "emotional",
-    "hysterical",
-    "irrational",
-    "clueless",
-    "brainwashed",
-    "sheep",
-    "puppet",
-    "follower",
-    # Religion & secular identities
-    "atheists",
-    "non-believers",
-    "secular people",
-    "buddhists",
-    "buddhist people",
-    "hindus",
-    "hindu people",
-    "christians",
-    "christian people",
-    "catholics",
-    "protestants",
-    "mormons",
-    "evangelicals",
-    "pagans",
-    "satanists",
-    "muslims",
-    "islamic people",
-    "islamists",
-    "muzzies",
-    "ragheads",
-    "jews",
-    "jewish people",
-    "zionists",
-    "orthodox jews",
-    # Migration / nationality
-    "immigrants",
-    "migrants",
-    "foreigners",
-    "outsiders",
-    "refugees",
-    "asylum seekers",
-    "expats",
-    "nationals",
-    "illegal aliens",
-    "illegals",
-    "invaders",
-    "colonizers",
-    "settlers",
-    # Gender & women
-    "women",
-    "woman",
-    "girl",
-    "girls",
-    "females",
-    "ladies",
-    "wives",
-    "mothers",
-    "bitches",
-    "sluts",
-    "whores",
-    "feminists",
-    "feminazis",
-    # LGBTQ+
-    "lgbtq",
-    "gay",
-    "gays",
-    "lesbian",
-    "lesbians",
-    "bisexual",
-    "transgender",
-    "trans",
-    "tranny",
-    "trannies",
-    "queer",
-    "queers",
-    "dyke",
-    "dykes",
-    "faggot",
-    "faggots",
-    "non-binary",
-    "drag queens",
-    "drag kings",
-]
+from lexicon import (
+    LexiconMatcher,
+    get_languages,
+    get_matcher,
+    get_term_categories,
+)
 
-othering_terms_de = [
-    # Dehumanizing terms (animals, pests, disease metaphors)
-    "tier",
-    "bestie",
-    "wild",
-    "barbarisch",
-    "unmensch",
-    "untermensch",
-    "primitiv",
-    "parasit",
-    "parasiten",
-    "ungeziefer",
-    "ratte",
-    "kakerlake",
-    "ungeheuer",
-    "monster",
-    "brut",
-    "affe",
-    "gorilla",
-    "hund",
-    "schwein",
-    "sau",
-    "ziege",
-    "insekt",
-    "egel",
-    "zecke",
-    "laus",
-    "maden",
-    "wurm",
-    "krebs",
-    "tumor",
-    "virus",
-    "pest",
-    "seuche",
-    "infektion",
-
-    # Moral judgment / worthlessness
-    "abschaum",
-    "müll",
-    "dreck",
-    "wertlos",
-    "minderwertig",
-    "degeneriert",
-    "asozial",
-    "gesindel",
-    "unwürdig",
-    "unrein",
-    "verdorben",
-    "schmutzig",
-    "ekelhaft",
-    "widerlich",
-    "verachtenswert",
-    "böse",
-    "verkommen",
-    "sündig",
-    "verflucht",
-    "last",
-    "schmarotzer",
-    "parasitär",
-    "sozialschmarotzer",
-
-    # Threatening / dangerous
-    "gefährlich",
-    "gewalttätig",
-    "aggressiv",
-    "feindselig",
-    "kriminell",
-    "verbrecher",
-    "gangster",
-    "schläger",
-    "abartig",
-    "radikal",
-    "extremist",
-    "fundamentalist",
-    "terrorist",
-    "raubtier",
-    "vergewaltiger",
-    "invasor",
-    "eindringling",
-    "besatzer",
-    "unterwanderer",
-    "bedrohung",
-
-    # Exclusion / separation
-    "außenseiter",
-    "fremdkörper",
-    "eindringling",
-    "alien",
-    "fremder",
-    "ausländer",
-    "feind",
-    "unerwünscht",
-    "illegal",
-    "illegale",
-    "abschieben",
-    "abschiebung",
-    "ausgestoßener",
-    "unerwünschte",
-    "kolonialist",
-    "siedler",
-
-    # Diminishing / infantilizing
-    "ignorant",
-    "rückständig",
-    "naiv",
-    "unzivilisiert",
-    "hilflos",
-    "schwach",
-    "dumm",
-    "faul",
-    "unreif",
-    "kindisch",
-    "lächerlich",
-    "überemotional",
-    "hysterisch",
-    "irrational",
-    "ahnungslos",
-    "hirngewaschen",
-    "schaf",
-    "mitläufer",
-    "marionette",
-
-    # Religion & secular identities
-    "atheisten",
-    "ungläubige",
-    "gottlose",
-    "säkularisten",
-    "buddhisten",
-    "hindus",
-    "christen",
-    "christlich",
-    "katholiken",
-    "protestanten",
-    "evangelikale",
-    "mormonen",
-    "heidnische",
-    "satanisten",
-    "muslime",
-    "islamisch",
-    "islamisten",
-    "juden",
-    "jüdisch",
-    "zionisten",
-    "orthodoxe juden",
-
-    # Migration / nationality
-    "migranten",
-    "immigranten",
-    "ausländer",
-    "fremde",
-    "flüchtlinge",
-    "asylbewerber",
-    "asylanten",
-    "expats",
-    "einheimische",
-    "illegale einwanderer",
-    "invasoren",
-    "kolonisatoren",
-    "siedler",
-
-    # Gender & women
-    "frauen",
-    "frau",
-    "mädchen",
-    "weibchen",
-    "damen",
-    "ehefrauen",
-    "mütter",
-    "schlampen",
-    "nutten",
-    "huren",
-    "fotzen",
-    "zicken",
-    "feministinnen",
-    "feminazis",
-
-    # LGBTQ+
-    "lgbt",
-    "schwul",
-    "schwule",
-    "lesbisch",
-    "lesben",
-    "bisexuell",
-    "transgender",
-    "trans",
-    "transe",
-    "queer",
-    "tunte",
-    "schwuchtel",
-    "nichtbinär",
-    "dragqueen",
-    "dragking",
-]
+# One matcher per language, loaded from lexicon/terms/<language>.json
+matchers = {language: get_matcher(language) for language in get_languages()}
 
+BODY_PATTERN = re.compile(rb'"body"\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)"')
+SUBREDDIT_PATTERN = re.compile(rb'"subreddit"\s*:\s*"([^"\\]*)"')
+CREATED_UTC_PATTERN = re.compile(rb'"created_utc"\s*:\s*"?(\d+)')
 
-# Split into single-word vs multi-word ENGLISH
-single_terms = [t for t in othering_terms if " " not in t]
-multi_terms = [t for t in othering_terms if " " in t]
 
-# Split into single-word vs multi-word GERMAN
-single_terms_de = [t for t in othering_terms if " " not in t]
-multi_terms_de = [t for t in othering_terms_de if " " in t]
+class CommentFilter:
+    """
+    Class to decide which comments to keep.
 
-# Regex for single-word terms
-single_patterns = [
-    re.compile(rf"(?i)(?<!\w){re.escape(t)}(?!\w)") for t in single_terms
-]
+    prefilter() works on the raw line and is only allowed to reject
+    comments that accept() would reject too. It pulls the body, subreddit
+    and created_utc out of the bytes and only decodes the body string, so
+    most lines are thrown away without a full json.loads.
+
+    Every reject is counted by reason in self.rejected.
+    """
+
+    def __init__(
+        self,
+        lexicon_matcher: LexiconMatcher,
+        max_tokens: int = 100,
+        subreddits: list[str] = None,
+        after: int = None,
+        before: int = None,
+    ):
+        self.matcher = lexicon_matcher
+        self.max_tokens = max_tokens
+        self.subreddits = {s.lower() for s in subreddits} if subreddits else None
+        self.after = after
+        self.before = before
+        self.rejected = Counter()
+
+    def reject(self, reason: str) -> bool:
+        """
+        Count a rejected comment.
+        """
+        self.rejected[reason] += 1
+        return False
+
+    def keep_date(self, created_utc: int) -> bool:
+        """
+        Check created_utc against the [after, before) window.
+        """
+        if self.after is not None and created_utc < self.after:
+            return False
+        if self.before is not None and created_utc >= self.before:
+            return False
+        return True
+
+    def keep_body(self, body: str) -> bool:
+        """
+        Check a decoded, lower cased comment body.
+        """
+        # Skip deleted/removed
+        if body in ("[deleted]", "[removed]"):
+            return self.reject("deleted")
+
+        # --- token limit ---
+        if len(body.split()) > self.max_tokens:
+            return self.reject("too_long")
+
+        # --- apply matching ONLY on comment body ---
+        if not self.matcher.search(body):
+            return self.reject("no_match")
+        return True
+
+    def prefilter(self, raw_line: bytes) -> bool:
+        """
+        Cheap check on the raw bytes. Returns False only for lines that
+        can't be kept, anything it can't decide is passed on.
+        """
+        body_match = BODY_PATTERN.search(raw_line)
+        if body_match is None:
+            return self.reject("no_body")
+        raw_body = body_match.group(1)
+
+        if raw_body in (b"[deleted]", b"[removed]"):
+            return self.reject("deleted")
+
+        if self.subreddits is not None:
+            subreddit_match = SUBREDDIT_PATTERN.search(raw_line)
+            if (
+                subreddit_match is not None
+                and subreddit_match.group(1).decode("utf-8", errors="ignore").lower()
+                not in self.subreddits
+            ):
+                return self.reject("subreddit")
+
+        if self.after is not None or self.before is not None:
+            created_match = CREATED_UTC_PATTERN.search(raw_line)
+            if created_match is not None and not self.keep_date(
+                int(created_match.group(1))
+            ):
+                return self.reject("date")
+
+        # decoding just the body string is much cheaper than the full object.
+        if b"\\" in raw_body:
+            try:
+                body = json.loads(b'"' + raw_body + b'"')
+            except ValueError:
+                return True
+        else:  # no escapes, the raw bytes are the text.
+            body = raw_body.decode("utf-8", errors="ignore")
+        return self.keep_body(body.lower())
+
+    def accept(self, obj: dict) -> bool:
+        """
+        Exact check on the parsed comment.
+        """
+        if self.subreddits is not None:
+            if str(obj.get("subreddit", "")).lower() not in self.subreddits:
+                return self.reject("subreddit")
+
+        if self.after is not None or self.before is not None:
+            try:
+                created_utc = int(obj.get("created_utc"))
+            except (TypeError, ValueError):
+                return self.reject("date")
+            if not self.keep_date(created_utc):
+                return self.reject("date")
+
+        body = obj.get("body", "")
+        if not isinstance(body, str):
+            return self.reject("no_body")
+        return self.keep_body(body.lower())
+
+
+class ExtractionMetrics:
+    """
+    Class to collect the counters of one dump: throughput, rejects by
+    reason and hits per lexicon term and category.
+    """
+
+    def __init__(self, term_categories: dict[str, list[str]] = None):
+        self.term_categories = term_categories or {}
+        self.start_time = time.time()
+        self.previous_seconds = 0.0  # time spent before a resume.
+
+        self.lines = 0
+        self.matches = 0
+        self.bytes_decompressed = 0
+        self.rejected = Counter()
+        self.term_hits = Counter()
+        self.category_hits = Counter()
 
-# Regex for single-word terms GERMAN
-single_patterns_de = [
-    re.compile(rf"(?i)(?<!\w){re.escape(t)}(?!\w)") for t in single_terms_de
+    def add_match(self, matched_terms: list[str]):
+        """
+        Count a kept comment and the terms it matched.
+        """
+        self.matches += 1
+        self.term_hits.update(matched_terms)
+        categories = set()
+        for term in matched_terms:
+            categories.update(self.term_categories.get(term, []))
+        self.category_hits.update(categories)
+
+    def seconds(self) -> float:
+        return self.previous_seconds + time.time() - self.start_time
+
+    def to_dict(self) -> dict:
+        """
+        Get the counters and rates as a serializable dict.
+        """
+        seconds = self.seconds()
+        return {
+            "seconds": round(seconds, 2),
+            "lines": self.lines,
+            "matches": self.matches,
+            "bytes_decompressed": self.bytes_decompressed,
+            "lines_per_sec": round(self.lines / seconds, 1) if seconds else 0.0,
+            "mb_decompressed_per_sec": (
+                round(self.bytes_decompressed / seconds / 2**20, 2) if seconds else 0.0
+            ),
+            "rejected": dict(self.rejected.most_common()),
+            "term_hits": dict(self.term_hits.most_common()),
+            "category_hits": dict(self.category_hits.most_common()),
+        }
+
+    def restore(self, state: dict):
+        """
+        Continue counting from a saved to_dict() state.
+        """
+        self.previous_seconds = state["seconds"]
+        self.lines = state["lines"]
+        self.matches = state["matches"]
+        self.bytes_decompressed = state["bytes_decompressed"]
+        self.rejected.update(state["rejected"])
+        self.term_hits.update(state["term_hits"])
+        self.category_hits.update(state["category_hits"])
+
+    def save(self, metrics_path: str):
+        """
+        Write the metrics file.
+        """
+        tmp_path = metrics_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, metrics_path)
+
+
+DEFAULT_FIELDS = [
+    "id",
+    "body",
+    "subreddit",
+    "created_utc",
+    "parent_id",
+    "matched_terms",
 ]
 
-#input_path = "/pl/active/blast-data/corpora/reddit/subreddits24/changemyview_comments.zst"
-#output_path = "full_comments/changemyview.jsonl"
 
-input_path = "/pl/active/blast-data/corpora/reddit/subreddits24/DePi_comments.zst"
-output_path = "full_comments/DePi_comments.jsonl"
+class CommentWriter:
+    """
+    Class to write the kept comments as jsonl.
+
+    Comments are projected to the given fields (None keeps the whole
+    object), buffered and written in batches, and zstd compressed if a
+    compression level is given. flush() ends the current zstd frame, so the
+    file is always valid up to the last flush and can be truncated there
+    and appended to when resuming.
+    """
+
+    def __init__(
+        self,
+        out,
+        fields: list[str] = None,
+        compression_level: int = None,
+        batch_size: int = 1000,
+    ):
+        self.out = out
+        self.fields = fields
+        self.batch_size = batch_size
+        self.batch = []
+
+        self.compressor = None
+        self.frame = None
+        if compression_level:
+            self.compressor = zstd.ZstdCompressor(level=compression_level)
+            self.frame = self.compressor.compressobj()
+
+    def project(self, obj: dict, matched_terms: list[str]) -> dict:
+        """
+        Keep only the configured fields of the comment.
+        """
+        if self.fields is None:
+            return {**obj, "matched_terms": matched_terms}
+
+        record = {}
+        for field in self.fields:
+            if field == "matched_terms":
+                record[field] = matched_terms
+            else:
+                record[field] = obj.get(field)
+        return record
+
+    def write(self, obj: dict, matched_terms: list[str]):
+        """
+        Add a comment to the current batch.
+        """
+        self.batch.append(json.dumps(self.project(obj, matched_terms)) + "\n")
+        if len(self.batch) >= self.batch_size:
+            self.write_batch()
+
+    def write_batch(self):
+        """
+        Write the current batch to the file.
+        """
+        if not self.batch:
+            return
+        data = "".join(self.batch).encode("utf-8")
+        self.batch = []
+        if self.frame is not None:
+            data = self.frame.compress(data)
+        self.out.write(data)
+
+    def flush(self):
+        """
+        Write everything buffered and end the zstd frame.
+        """
+        self.write_batch()
+        if self.frame is not None:
+            self.out.write(self.frame.flush())
+            self.frame = self.compressor.compressobj()
+        self.out.flush()
+
+
+def read_comments(path: str):
+    """
+    Iterate over the comments of an extraction output (.jsonl or .jsonl.zst).
+    """
+    with open(path, "rb") as fh:
+        if path.endswith(".zst"):
+            dctx = zstd.ZstdDecompressor(max_window_size=2**31)
+            fh = dctx.stream_reader(fh, read_across_frames=True)
+        with io.TextIOWrapper(fh, encoding="utf-8") as lines:
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+
+
+DEFAULT_INPUT = "/pl/active/blast-data/corpora/reddit/subreddits24/DePi_comments.zst"
+PROGRESS_INTERVAL = 500000
+
+# progress counters shared by all workers, set by init_worker().
+total_lines = None
+total_matches = None
+
+
+def init_worker(lines_counter, matches_counter):
+    """
+    Give a pool worker access to the shared progress counters.
+    """
+    global total_lines, total_matches
+    total_lines = lines_counter
+    total_matches = matches_counter
+
+
+def report_progress(lines: int, matches: int):
+    """
+    Add a worker's progress to the shared counters.
+    """
+    if total_lines is None:
+        return
+    with total_lines.get_lock():
+        total_lines.value += lines
+    with total_matches.get_lock():
+        total_matches.value += matches
+
+
+def get_output_path(
+    input_path: str, output_dir: str, compressed: bool, path_hash: bool = False
+) -> str:
+    """
+    Map a dump like DePi_comments.zst to output_dir/DePi_comments.jsonl,
+    or DePi_comments.jsonl.zst if the output is compressed. With path_hash
+    a short hash of the full input path is added, e.g.
+    DePi_comments.3f2a9c1b.jsonl.
+    """
+    name = os.path.basename(input_path)
+    if name.endswith(".zst"):
+        name = name[: -len(".zst")]
+    if path_hash:
+        digest = hashlib.sha1(os.path.abspath(input_path).encode("utf-8"))
+        name = f"{name}.{digest.hexdigest()[:8]}"
+    extension = ".jsonl.zst" if compressed else ".jsonl"
+    return os.path.join(output_dir, name + extension)
+
+
+def get_output_paths(input_paths: list[str], output_dir: str, compressed: bool) -> list[str]:
+    """
+    The output path of every input. Dumps with the same file name in
+    different directories get a path hash in their name, so they don't
+    share an output, checkpoint and metrics file.
+    """
+    output_paths = [
+        get_output_path(path, output_dir, compressed) for path in input_paths
+    ]
+    counts = Counter(output_paths)
+    return [
+        get_output_path(path, output_dir, compressed, path_hash=True)
+        if counts[output_path] > 1
+        else output_path
+        for path, output_path in zip(input_paths, output_paths)
+    ]
+
+
+def get_checkpoint_path(output_path: str) -> str:
+    """
+    The checkpoint of an output file is stored next to it.
+    """
+    return output_path + ".checkpoint.json"
+
+
+def load_checkpoint(checkpoint_path: str) -> dict:
+    """
+    Load a checkpoint, or None if there is none.
+    """
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, "r") as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint: dict, checkpoint_path: str):
+    """
+    Write the checkpoint atomically, so a job killed mid-write
+    still leaves the previous checkpoint behind.
+    """
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=4)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def skip_bytes(reader, count: int):
+    """
+    Decompress and throw away the first count bytes of the stream.
+    """
+    remaining = count
+    while remaining > 0:
+        chunk = reader.read(min(remaining, 2**24))
+        if not chunk:
+            raise ValueError("Checkpoint is past the end of the dump.")
+        remaining -= len(chunk)
+
+
+def process_line(raw_line: bytes, comment_filter: CommentFilter) -> dict:
+    """
+    Parse one line of the dump, returns the comment if it should be kept.
+    """
+    # --- cheap checks on the raw bytes FIRST ---
+    if not comment_filter.prefilter(raw_line):
+        return None
+
+    try:
+        obj = json.loads(raw_line.decode("utf-8", errors="ignore"))
+    except ValueError:
+        comment_filter.reject("json_error")
+        return None
+
+    if not comment_filter.accept(obj):
+        return None
+
+    return obj
+
+
+def get_metrics_path(output_path: str) -> str:
+    """
+    The metrics of an output file are stored next to it.
+    """
+    return output_path + ".metrics.json"
+
+
+def extract_file(
+    input_path: str,
+    output_path: str,
+    comment_filter: CommentFilter,
+    checkpoint_interval: int = 1000000,
+    resume: bool = True,
+    fields: list[str] = DEFAULT_FIELDS,
+    compression_level: int = 3,
+    write_batch_size: int = 1000,
+    term_categories: dict[str, list[str]] = None,
+) -> dict:
+    """
+    Extract the comments of one zst dump that pass the filter.
+    Every checkpoint_interval lines the position in the dump and in the
+    output file is saved, so a killed job can pick up where it stopped.
+    Metrics are written every PROGRESS_INTERVAL lines and at the end.
+    Returns the counters for the manifest.
+    """
+    checkpoint_path = get_checkpoint_path(output_path)
+    metrics_path = get_metrics_path(output_path)
+    checkpoint = None
+    if resume and os.path.exists(output_path):
+        checkpoint = load_checkpoint(checkpoint_path)
+
+    if checkpoint is not None and checkpoint["done"]:
+        print(f"Already done: {input_path}")
+        return checkpoint["result"]
+
+    metrics = ExtractionMetrics(term_categories)
+    comment_filter.rejected = metrics.rejected
+    output_mode = "wb"
+    if checkpoint is not None:
+        if "metrics" in checkpoint:
+            metrics.restore(checkpoint["metrics"])
+        else:  # checkpoint written before metrics were kept.
+            metrics.lines = checkpoint["lines"]
+            metrics.matches = checkpoint["matches"]
+            metrics.bytes_decompressed = checkpoint["decompressed_offset"]
+        output_mode = "r+b"
+        print(f"Resuming {input_path} after {metrics.lines:,} comments.")
+
+    reported_counter = metrics.lines
+    reported_matches = metrics.matches
+
+    def result():
+        return {
+            "input": input_path,
+            "output": output_path,
+            "metrics": metrics_path,
+            "comments": metrics.lines,
+            "matches": metrics.matches,
+            "seconds": round(metrics.seconds(), 2),
+        }
+
+    def write_checkpoint(done: bool):
+        writer.flush()
+        os.fsync(out.fileno())
+        metrics.save(metrics_path)
+        save_checkpoint(
+            {
+                "input": input_path,
+                "done": done,
+                "lines": metrics.lines,
+                "matches": metrics.matches,
+                "decompressed_offset": metrics.bytes_decompressed,
+                "compressed_offset": fh.tell(),  # read so far, for reference.
+                "output_position": out.tell(),
+                "metrics": metrics.to_dict(),
+                "result": result(),
+            },
+            checkpoint_path,
+        )
+
+    with open(input_path, "rb") as fh, open(output_path, output_mode) as out:
+        if checkpoint is not None:
+            # drop anything written after the checkpoint.
+            out.truncate(checkpoint["output_position"])
+            out.seek(checkpoint["output_position"])
+
+        writer = CommentWriter(out, fields, compression_level, write_batch_size)
+
+        dctx = zstd.ZstdDecompressor(max_window_size=2**31)
+
+        with dctx.stream_reader(fh) as reader:
+            # zstd can't start decoding mid-frame, so the first part of the
+            # dump is decompressed again, but not split, parsed or matched.
+            skip_bytes(reader, metrics.bytes_decompressed)
+
+            buffer = b""
+            finished = False
+
+            while not finished:
+                chunk = reader.read(2**20)  # 1MB
+                if chunk:
+                    buffer += chunk
+                    lines = buffer.split(b"\n")
+                    buffer = lines.pop()
+                else:  # the last line may have no trailing newline.
+                    finished = True
+                    lines = [buffer] if buffer else []
+
+                for raw_line in lines:
+                    obj = process_line(raw_line, comment_filter)
+                    metrics.lines += 1
+                    # decompressed bytes up to the end of the last processed line.
+                    metrics.bytes_decompressed += len(raw_line) + 1
+
+                    # --- save match ---
+                    if obj is not None:
+                        matched_terms = comment_filter.matcher.find_terms(
+                            obj.get("body", "")
+                        )
+                        metrics.add_match(matched_terms)
+                        writer.write(obj, matched_terms)
+
+                    if metrics.lines % PROGRESS_INTERVAL == 0:
+                        report_progress(
+                            metrics.lines - reported_counter,
+                            metrics.matches - reported_matches,
+                        )
+                        reported_counter = metrics.lines
+                        reported_matches = metrics.matches
+                        metrics.save(metrics_path)
+
+                    if metrics.lines % checkpoint_interval == 0:
+                        write_checkpoint(done=False)
+
+            write_checkpoint(done=True)
+
+    report_progress(
+        metrics.lines - reported_counter, metrics.matches - reported_matches
+    )
+
+    return result()
+
+
+def extract_worker(job: tuple[str, str, dict]) -> dict:
+    """
+    Run extract_file() in a pool worker. Errors are recorded in the
+    manifest so one bad dump does not stop the others.
+    """
+    input_path, output_path, options = job
+    try:
+        return extract_file(input_path, output_path, **options)
+    except Exception as e:
+        return {"input": input_path, "output": output_path, "error": str(e)}
 
-counter = 0
-matches = 0
 
-with open(input_path, "rb") as fh, open(output_path, "w") as out:
-    dctx = zstd.ZstdDecompressor(max_window_size=2**31)
+def expand_inputs(patterns: list[str]) -> list[str]:
+    """
+    Expand the input globs into a sorted list of unique dump files. Paths
+    to the same file, e.g. x/A.zst and ./x/A.zst, are kept once.
+    """
+    paths = {}
+    for pattern in patterns:
+        expanded = glob.glob(pattern)
+        if not expanded:
+            print(f"No files match: {pattern}")
+        for path in expanded:
+            paths.setdefault(os.path.realpath(path), path)
+    return sorted(paths.values())
 
-    with dctx.stream_reader(fh) as reader:
-        buffer = b""
 
-        while True:
-            chunk = reader.read(2**20)  # 1MB
-            if not chunk:
-                break
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract lexicon matching comments from zst subreddit dumps."
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        default=[DEFAULT_INPUT],
+        help="zst dumps to process, as paths or globs.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="full_comments",
+        help="Directory for the per-input jsonl files.",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default="manifest.json",
+        help="Name of the merged manifest written to the output directory.",
+    )
+    parser.add_argument(
+        "--language",
+        choices=sorted(matchers),
+        default="de",
+        help="Lexicon to match the comments against.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1)),
+        help="Number of dumps to process in parallel.",
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=100,
+        help="Skip comments with more whitespace separated tokens than this.",
+    )
+    parser.add_argument(
+        "--subreddits",
+        nargs="+",
+        help="Only keep comments from these subreddits.",
+    )
+    parser.add_argument(
+        "--after", type=int, help="Only keep comments with created_utc >= this."
+    )
+    parser.add_argument(
+        "--before", type=int, help="Only keep comments with created_utc < this."
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=int,
+        default=1000000,
+        help="Save a checkpoint every this many comments.",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore existing checkpoints and start every dump from the beginning.",
+    )
+    parser.add_argument(
+        "--fields",
+        nargs="+",
+        default=DEFAULT_FIELDS,
+        help="Fields to keep for each comment, 'all' keeps the whole object.",
+    )
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        default=3,
+        help="zstd level for the output files, 0 writes plain jsonl.",
+    )
+    parser.add_argument(
+        "--write_batch_size",
+        type=int,
+        default=1000,
+        help="Number of comments to buffer before writing.",
+    )
+    args = parser.parse_args()
 
-            buffer += chunk
-            lines = buffer.split(b"\n")
-            buffer = lines.pop()
+    comment_filter = CommentFilter(
+        matchers[args.language],
+        max_tokens=args.max_tokens,
+        subreddits=args.subreddits,
+        after=args.after,
+        before=args.before,
+    )
 
-            for raw_line in lines:
-                counter += 1
+    input_paths = expand_inputs(args.inputs)
+    os.makedirs(args.output_dir, exist_ok=True)
+    options = {
+        "comment_filter": comment_filter,
+        "checkpoint_interval": args.checkpoint_interval,
+        "resume": not args.restart,
+        "fields": None if args.fields == ["all"] else args.fields,
+        "compression_level": args.compression_level,
+        "write_batch_size": args.write_batch_size,
+        "term_categories": get_term_categories(args.language),
+    }
+    output_paths = get_output_paths(
+        input_paths, args.output_dir, args.compression_level > 0
+    )
+    jobs = [
+        (path, output_path, options)
+        for path, output_path in zip(input_paths, output_paths)
+    ]
 
-                if counter % 500000 == 0:
-                    print(
-                        f"Processed {counter:,} comments; matches so far: {matches:,}"
-                    )
+    num_workers = max(1, min(args.workers, len(jobs)))
+    print(f"Processing {len(jobs)} dumps with {num_workers} workers.")
 
-                try:
-                    line = raw_line.decode("utf-8", errors="ignore")
-                except:
-                    continue
+    lines_counter = multiprocessing.Value("q", 0)
+    matches_counter = multiprocessing.Value("q", 0)
+    results = []
+    with multiprocessing.Pool(
+        num_workers,
+        initializer=init_worker,
+        initargs=(lines_counter, matches_counter),
+    ) as pool:
+        pending = pool.imap_unordered(extract_worker, jobs)
+        last_reported = 0
+        while len(results) < len(jobs):
+            try:
+                result = pending.next(timeout=10)
+            except multiprocessing.TimeoutError:
+                result = None
 
-                # --- parse JSON FIRST ---
-                try:
-                    obj = json.loads(line)
-                except:
-                    continue
+            if result is not None:
+                results.append(result)
+                status = (
+                    result["error"]
+                    if "error" in result
+                    else f"{result['matches']:,} matches"
+                )
+                print(f"Finished {result['input']}: {status}")
 
-                body = obj.get("body", "").lower()
+            if lines_counter.value - last_reported >= PROGRESS_INTERVAL:
+                last_reported = lines_counter.value
+                print(
+                    f"Processed {lines_counter.value:,} comments; "
+                    f"matches so far: {matches_counter.value:,}"
+                )
 
-                # Skip deleted/removed
-                if body in ("[deleted]", "[removed]"):
-                    continue
+    manifest = {
+        "language": args.language,
+        "lexicon_version": matchers[args.language].version,
+        "fields": options["fields"],
+        "compression_level": args.compression_level,
+        "time_saved": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "total_comments": sum(r.get("comments", 0) for r in results),
+        "total_matches": sum(r.get("matches", 0) for r in results),
+        "files": sorted(results, key=lambda r: r["input"]),
+    }
 
-                # --- apply matching ONLY on comment body ---
-                if not (
-                    any(term in body for term in multi_terms_de)
-                    or any(p.search(body) for p in single_patterns_de)
-                ):
-                    continue
+    # merge the per-file metrics.
+    totals = {key: Counter() for key in ["rejected", "term_hits", "category_hits"]}
+    for result in results:
+        if "metrics" in result and os.path.exists(result["metrics"]):
+            with open(result["metrics"], "r") as f:
+                file_metrics = json.load(f)
+            for key, total in totals.items():
+                total.update(file_metrics[key])
+    for key, total in totals.items():
+        manifest[key] = dict(total.most_common())
 
-                # --- token limit ---
-                token_count = len(body.split())
-                if token_count > 100:
-                    continue
+    with open(os.path.join(args.output_dir, args.manifest), "w") as f:
+        json.dump(manifest, f, indent=4, ensure_ascii=False)
 
-                # --- save match ---
-                matches += 1
-                out.write(json.dumps(obj) + "\n")
+    print(
+        f"Done: {manifest['total_comments']:,} comments, "
+        f"{manifest['total_matches']:,} matches."
+    )
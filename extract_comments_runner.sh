@@ -28,6 +28,10 @@ conda activate bt_2025
 
 echo "Running python..."
 python3 -c "print('Python works')"
-python extract_comments.py
+# dumps to process, as space separated paths or quoted globs such as ".../subreddits24/*_comments.zst"
+INPUTS=${INPUTS:-"/pl/active/blast-data/corpora/reddit/subreddits24/DePi_comments.zst"}
+# split into one argument per path, globs are left for python to expand.
+read -r -a INPUT_PATHS <<< "$INPUTS"
+python extract_comments.py "${INPUT_PATHS[@]}" --workers "${SLURM_CPUS_PER_TASK:-1}"
 
 echo "DONE"
\ No newline at end of file
@@ -0,0 +1,9 @@
+from lexicon.matcher import LexiconMatcher
+from lexicon.loader import (
+    get_languages,
+    get_lexicon_hash,
+    get_matcher,
+    get_term_categories,
+    load_lexicon,
+    load_terms,
+)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+
+from lexicon.matcher import LexiconMatcher
+
+"""
+Load the othering lexicons from lexicon/terms/<language>.json and build
+their matchers. Each matcher is built once per process and carries a hash
+of its term file in its version, so outputs can be traced back to the
+exact lexicon they were matched with.
+"""
+
+TERMS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "terms")
+
+# bump when LexiconMatcher changes what it matches, so the version changes.
+MATCHER_VERSION = 1
+
+_matchers = {}  # matchers already loaded in this process.
+
+
+def get_languages() -> list[str]:
+    """
+    Get the languages there is a lexicon for.
+    """
+    return sorted(
+        name[: -len(".json")]
+        for name in os.listdir(TERMS_PATH)
+        if name.endswith(".json")
+    )
+
+
+def _read_lexicon_file(language: str) -> bytes:
+    """
+    Read the raw term file of a language.
+    """
+    lexicon_file = os.path.join(TERMS_PATH, f"{language}.json")
+    if not os.path.exists(lexicon_file):
+        raise ValueError(
+            f"No lexicon for language '{language}', choose from {get_languages()}."
+        )
+    with open(lexicon_file, "rb") as f:
+        return f.read()
+
+
+def load_lexicon(language: str) -> dict:
+    """
+    Load the lexicon of a language.
+    returns
+        - dict: {"language": str, "version": int, "categories": {category: [term]}}
+    """
+    return json.loads(_read_lexicon_file(language))
+
+
+def load_terms(language: str) -> list[str]:
+    """
+    Load the terms of all categories of a language, in file order.
+    """
+    terms = []
+    for category_terms in load_lexicon(language)["categories"].values():
+        terms.extend(term for term in category_terms if term not in terms)
+    return terms
+
+
+def get_term_categories(language: str) -> dict[str, list[str]]:
+    """
+    Map each (lower case) term to the categories it is listed under.
+    """
+    term_categories = {}
+    for category, terms in load_lexicon(language)["categories"].items():
+        for term in terms:
+            term_categories.setdefault(term.lower(), []).append(category)
+    return term_categories
+
+
+def get_lexicon_hash(language: str) -> str:
+    """
+    Hash of the term file and matcher version.
+    """
+    digest = hashlib.sha256(_read_lexicon_file(language))
+    digest.update(f"matcher-{MATCHER_VERSION}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_matcher(language: str) -> LexiconMatcher:
+    """
+    Get the matcher for a language, built once per process and rebuilt if
+    the term file changes. Building takes about 10ms, most of it compiling
+    the patterns, so it isn't cached on disk (unpickling a compiled
+    pattern compiles it again).
+    """
+    lexicon_hash = get_lexicon_hash(language)
+    if lexicon_hash not in _matchers:
+        lexicon = load_lexicon(language)
+        _matchers[lexicon_hash] = LexiconMatcher(
+            load_terms(language),
+            version=f"{language}-v{lexicon['version']}-{lexicon_hash[:12]}",
+        )
+    return _matchers[lexicon_hash]
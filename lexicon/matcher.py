@@ -0,0 +1,100 @@
+import re
+
+"""
+Single-pass matcher for othering lexicons.
+Compiles every term into one trie-shaped regex so a text is scanned once,
+instead of once per term.
+"""
+
+
+def _build_trie(terms: list[str]) -> dict:
+    """
+    Build a character trie from the terms. The "" key marks the end of a term.
+    """
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return trie
+
+
+def _trie_to_regex(node: dict) -> str:
+    """
+    Convert a trie node to a regex. Longer continuations are tried before
+    the end of a term, so the longest term at a position wins and shorter
+    ones are only used when the longer ones fail the word boundary check.
+    """
+    is_end = "" in node
+    branches = [
+        re.escape(char) + _trie_to_regex(child)
+        for char, child in sorted(node.items())
+        if char != ""
+    ]
+    if not branches:
+        return ""
+
+    if len(branches) == 1 and not is_end:
+        return branches[0]
+
+    regex = "(?:" + "|".join(branches) + ")"
+    if is_end:
+        regex += "?"
+    return regex
+
+
+class LexiconMatcher:
+    """
+    Class to match a list of terms against text with word boundaries.
+    Matching is case-insensitive, the same as the per-term patterns
+    (?i)(?<!\\w)term(?!\\w) it replaces. The text is lower cased first,
+    which is about twice as fast as a re.IGNORECASE pattern. The patterns
+    are case-sensitive, so every match is a term of the lexicon (with
+    re.IGNORECASE, e.g. "ſ" would match "s").
+    """
+
+    def __init__(self, terms: list[str], version: str = None):
+        self.terms = sorted({term.lower() for term in terms})
+        self.version = version
+
+        trie_regex = _trie_to_regex(_build_trie(self.terms))
+
+        # pattern for a yes/no answer, stops at the first hit.
+        self.pattern = re.compile(rf"(?<!\w){trie_regex}(?!\w)")
+
+        # zero-width pattern so overlapping hits (e.g. "jews" inside
+        # "orthodox jews") are all reported.
+        self.finder = re.compile(rf"(?<!\w)(?=({trie_regex})(?!\w))")
+
+        # shorter terms that also match wherever a longer term matches,
+        # e.g. "illegal" for "illegal aliens".
+        self.prefix_terms = {}
+        for term in self.terms:
+            prefixes = [
+                other
+                for other in self.terms
+                if len(other) < len(term)
+                and term.startswith(other)
+                and re.match(r"\W", term[len(other)])
+            ]
+            if prefixes:
+                self.prefix_terms[term] = prefixes
+
+    def search(self, text: str) -> bool:
+        """
+        Check if any term occurs in the text.
+        """
+        return self.pattern.search(text.lower()) is not None
+
+    def find_terms(self, text: str) -> list[str]:
+        """
+        Get the unique terms that occur in the text, in order of first occurrence.
+        """
+        found = {}
+        for match in self.finder.finditer(text.lower()):
+            term = match.group(1)
+            found[term] = None
+            for prefix in self.prefix_terms.get(term, []):
+                found[prefix] = None
+        return list(found)
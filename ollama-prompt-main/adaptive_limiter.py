@@ -0,0 +1,166 @@
+import asyncio
+import time
+from collections import deque
+
+"""
+Concurrency limiter for the async annotation engine. The number of
+requests in flight is tuned from the observed latency and errors
+(additive increase, multiplicative decrease), so the parallelism does
+not have to be guessed for each GPU.
+"""
+
+
+class AdaptiveLimiter:
+    """
+    Class to limit the requests in flight with AIMD.
+        - the latency is the p10 of the last recent requests and the
+          baseline the p10 of the last window requests, drifting up
+          slowly. Low percentiles ignore the normal spread of LLM
+          latencies (long answers), but rise with the queueing delay that
+          every request pays once the server is saturated.
+        - every request while the latency is within tolerance * baseline
+          grows the limit by 1/limit, so about +1 per round of requests.
+        - when the latency stays past tolerance * baseline for a round of
+          requests (they are queueing on the server) the limit shrinks by
+          backoff.
+        - on an error the limit is halved.
+    Decreases happen at most once per round, so one slow batch does not
+    collapse the limit.
+    """
+
+    def __init__(
+        self,
+        initial: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        tolerance: float = 2.0,
+        backoff: float = 0.9,
+        window: int = 200,
+        recent: int = 20,
+        logger=None,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.logger = logger
+
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+        self.latencies = deque(maxlen=window)
+        self.recent = recent
+        self.min_latency = None  # baseline, slowly forgets old minimums.
+        self.latency = None  # p10 of the recent requests.
+        self.slow_streak = 0  # requests in a row past the tolerance.
+        self.since_decrease = 0
+        self.completed = 0
+        self.errors = 0
+        self.peak_limit = int(self.limit)
+
+    @property
+    def concurrency(self) -> int:
+        return int(self.limit)
+
+    def slot(self) -> "LimiterSlot":
+        """
+        Context manager that holds a slot and times the request in it.
+        """
+        return LimiterSlot(self)
+
+    async def acquire(self):
+        """
+        Wait for a free slot.
+        """
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.concurrency)
+            self.in_flight += 1
+
+    async def release(self, latency: float, error: bool = False):
+        """
+        Free the slot and update the limit from the request's outcome.
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            self.completed += 1
+            self.since_decrease += 1
+            before = self.concurrency
+
+            if error:
+                self.errors += 1
+                self._decrease(0.5)
+            else:
+                self._update_latency(latency)
+                if self.min_latency is None:  # too few requests to judge yet.
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                elif self.latency > self.tolerance * self.min_latency:
+                    self.slow_streak += 1
+                    if self.slow_streak >= self.concurrency:  # sustained rise.
+                        self._decrease(self.backoff)
+                else:
+                    self.slow_streak = 0
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.peak_limit = max(self.peak_limit, self.concurrency)
+            if self.logger and self.concurrency != before:
+                self.logger.info(
+                    f"Concurrency {before} -> {self.concurrency} "
+                    f"(latency {self.latency or 0:.2f}s, "
+                    f"baseline {self.min_latency or 0:.2f}s, errors {self.errors})."
+                )
+            # wake only as many waiters as there are free slots.
+            self.condition.notify(max(0, self.concurrency - self.in_flight))
+
+    @staticmethod
+    def get_p10(latencies: list) -> float:
+        return sorted(latencies)[len(latencies) // 10]
+
+    def _update_latency(self, latency: float):
+        self.latencies.append(latency)
+        if len(self.latencies) < self.recent:
+            return
+        self.latency = self.get_p10(list(self.latencies)[-self.recent :])
+        window_p10 = self.get_p10(self.latencies)
+        if self.min_latency is None:
+            self.min_latency = window_p10
+            return
+        # let the baseline drift up slowly, so it follows longer prompts.
+        self.min_latency = min(window_p10, self.min_latency * 1.0001)
+
+    def _decrease(self, factor: float):
+        if self.since_decrease < self.concurrency:
+            return
+        self.limit = max(self.min_limit, self.limit * factor)
+        self.since_decrease = 0
+        self.slow_streak = 0
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "peak_concurrency": self.peak_limit,
+            "completed": self.completed,
+            "errors": self.errors,
+            "latency": self.latency,
+            "baseline_latency": self.min_latency,
+        }
+
+
+class LimiterSlot:
+    """
+    Class to time a request held in a limiter slot.
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter):
+        self.limiter = limiter
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        self.start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.limiter.release(
+            time.perf_counter() - self.start, error=exc_type is not None
+        )
+        return False
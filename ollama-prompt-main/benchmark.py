@@ -0,0 +1,266 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from mock_ollama import MockOllamaServer
+from ollama_utils import Annotate
+from utils import get_logger
+
+"""
+Throughput benchmark of Annotate.process_docs against a local mock Ollama
+server (see mock_ollama.py), so engine changes can be compared offline.
+Every combination of engine, workers, batch size and dataset size runs
+the real client and annotation code on synthetic docs and reports
+docs/sec, p50/p99 request latency and the time spent checkpointing.
+Results can be saved with --out and checked against an earlier run with
+--baseline.
+"""
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+
+
+def get_args(bench, engine: str, workers: int, batch_size: int) -> argparse.Namespace:
+    """
+    Annotate arguments of one run, like run.py with the default config.
+    """
+    return argparse.Namespace(
+        dataset="benchmark.json",
+        out_filename="benchmark_results.json",
+        host=None,
+        port=None,
+        endpoints=None,
+        model="mock",
+        seed=42,
+        temperature=0.2,
+        workers=workers,
+        save_interval=100,
+        max_retries=bench.max_retries,
+        transport_retries=5,
+        backoff_seconds=0.1,
+        resume_attempts=3,
+        engine=engine,
+        min_concurrency=1,
+        max_concurrency=max(workers, bench.max_concurrency),
+        batch_size=batch_size,
+        prompt_layout="flat",
+        keep_alive=None,
+        samples=1,
+        sweep=None,
+        cache_path=None,
+        cache_max_mb=1024,
+        no_cache=True,
+    )
+
+
+def make_docs(n_docs: int) -> dict:
+    """
+    Synthetic docs of varying length.
+    """
+    words = "die leute aus dem dorf sagen immer dass die anderen schuld sind".split()
+    return {
+        str(i): {"text": f"comment {i}: " + " ".join(words[: 3 + i % len(words)])}
+        for i in range(n_docs)
+    }
+
+
+def get_percentile(values: list, q: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def instrument(annotator: Annotate, timings: dict):
+    """
+    Time the requests and the checkpointing (result storing, log appends
+    and the final compaction) of an annotator.
+    """
+    client = annotator.ollama_client
+    send, asend = client.send, client.asend
+    store_result, finish_results = annotator.store_result, annotator.finish_results
+
+    def timed(function, key):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings[key].append(time.perf_counter() - start)
+
+        return wrapper
+
+    async def timed_asend(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await asend(*args, **kwargs)
+        finally:
+            timings["request"].append(time.perf_counter() - start)
+
+    client.send = timed(send, "request")
+    client.asend = timed_asend
+    annotator.store_result = timed(store_result, "checkpoint")
+    annotator.finish_results = timed(finish_results, "checkpoint")
+
+
+def run_case(bench, engine: str, workers: int, batch_size: int, n_docs: int, logger) -> dict:
+    """
+    Annotate n_docs synthetic docs against a fresh mock server.
+    """
+    mock = MockOllamaServer(
+        latency=bench.latency,
+        latency_ms=bench.latency_ms,
+        latency_spread=bench.latency_spread,
+        max_parallel=bench.max_parallel,
+        invalid_rate=bench.invalid_rate,
+        error_rate=bench.error_rate,
+        seed=bench.seed,
+    )
+    args = get_args(bench, engine, workers, batch_size)
+    args.endpoints = [mock.start()]
+    timings = {"request": [], "checkpoint": []}
+
+    try:
+        with tempfile.TemporaryDirectory() as results_path:
+            annotator = Annotate(
+                args,
+                SCRIPT_PATH,
+                results_path,
+                results_path,
+                logger=logger,
+                docs=make_docs(n_docs),
+                prompt_file=bench.prompt_file,
+            )
+            instrument(annotator, timings)
+            start = time.perf_counter()
+            annotator.process_docs()
+            elapsed = time.perf_counter() - start
+            failed = annotator.index.counts()["failed"]
+    finally:
+        mock.stop()
+
+    checkpoint = sum(timings["checkpoint"])
+    p50 = get_percentile(timings["request"], 0.5)
+    p99 = get_percentile(timings["request"], 0.99)
+    return {
+        "engine": engine,
+        "workers": workers,
+        "batch_size": batch_size,
+        "docs": n_docs,
+        "seconds": round(elapsed, 3),
+        "docs_per_sec": round(n_docs / elapsed, 2),
+        "requests": len(timings["request"]),
+        "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+        "p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+        "checkpoint_s": round(checkpoint, 3),
+        "checkpoint_pct": round(100 * checkpoint / elapsed, 2),
+        "failed_docs": failed,
+        "server": mock.stats(),
+    }
+
+
+def get_case_key(result: dict) -> tuple:
+    return result["engine"], result["workers"], result["batch_size"], result["docs"]
+
+
+def check_baseline(results: list, baseline_path: str, tolerance: float) -> list:
+    """
+    Cases whose throughput dropped more than tolerance below the baseline.
+    """
+    with open(baseline_path, "r") as f:
+        baseline = {get_case_key(r): r for r in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        old = baseline.get(get_case_key(result))
+        if old and result["docs_per_sec"] < old["docs_per_sec"] * (1 - tolerance):
+            regressions.append((result, old))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark annotation throughput against a mock Ollama server."
+    )
+    parser.add_argument("--engines", nargs="+", default=["thread", "async"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[4, 16])
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--docs", nargs="+", type=int, default=[200])
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=32,
+        help="Highest number of requests in flight for the async engine.",
+    )
+    parser.add_argument("--max_retries", type=int, default=5)
+    parser.add_argument(
+        "--prompt_file",
+        default="prompts/classify_othering_german.json",
+        help="Prompt file the docs are annotated with.",
+    )
+
+    # mock server behaviour.
+    parser.add_argument(
+        "--latency",
+        choices=["constant", "uniform", "exponential", "lognormal"],
+        default="lognormal",
+    )
+    parser.add_argument("--latency_ms", type=float, default=50.0)
+    parser.add_argument("--latency_spread", type=float, default=0.5)
+    parser.add_argument(
+        "--max_parallel",
+        type=int,
+        default=8,
+        help="Requests the mock serves at once, like OLLAMA_NUM_PARALLEL.",
+    )
+    parser.add_argument("--invalid_rate", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+
+    # saving and regression checks.
+    parser.add_argument("--out", help="Save the results to this json file.")
+    parser.add_argument("--baseline", help="Results json of an earlier run to compare to.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed drop in docs/sec below the baseline.",
+    )
+    bench = parser.parse_args()
+
+    logger = get_logger()
+    logger.setLevel(logging.ERROR)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    results = []
+    for engine, workers, batch_size, n_docs in itertools.product(
+        bench.engines, bench.workers, bench.batch_sizes, bench.docs
+    ):
+        result = run_case(bench, engine, workers, batch_size, n_docs, logger)
+        results.append(result)
+        print(
+            f"{engine:>6} workers={workers:<3} batch={batch_size:<3} docs={n_docs:<6} "
+            f"{result['docs_per_sec']:>8.2f} docs/s  p50 {result['p50_ms']} ms  "
+            f"p99 {result['p99_ms']} ms  checkpoint {result['checkpoint_pct']}%  "
+            f"failed {result['failed_docs']}  server {result['server']}",
+            flush=True,
+        )
+
+    if bench.out:
+        with open(bench.out, "w") as f:
+            json.dump({"settings": vars(bench), "results": results}, f, indent=4)
+
+    if bench.baseline:
+        regressions = check_baseline(results, bench.baseline, bench.tolerance)
+        for result, old in regressions:
+            print(
+                f"Regression {get_case_key(result)}: {result['docs_per_sec']} docs/s, "
+                f"baseline {old['docs_per_sec']} docs/s."
+            )
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
@@ -0,0 +1,142 @@
+import json
+import os
+import queue
+import threading
+import time
+
+"""
+Append-only JSONL log of annotated docs. Each finished doc is one line,
+written by a background thread, so checkpointing costs O(1) per doc and
+never blocks result collection. The final results json is compacted
+from the log at the end of a run.
+"""
+
+
+class CheckpointLog:
+    """
+    Class to append {"id": doc_id, "doc": doc} lines to a log file.
+    The writer thread flushes after every batch it drains from the queue
+    and fsyncs every fsync_every docs or fsync_seconds, whichever is first.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fsync_every: int = 100,
+        fsync_seconds: float = 5.0,
+        logger=None,
+    ):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        self.logger = logger
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+        if self.file.tell() > 0:  # end a line cut off by a crash.
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.file.write("\n")
+
+        self.queue = queue.Queue()
+        self.written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def append(self, doc_id: str, doc: dict):
+        """
+        Queue a finished doc for writing.
+        """
+        if self.error is not None:
+            raise RuntimeError(f"Checkpoint log writer failed: {self.error}")
+        self.queue.put((doc_id, doc))
+
+    def _write_loop(self):
+        unsynced = 0
+        last_sync = time.monotonic()
+        closing = False
+        while not closing:
+            try:
+                item = self.queue.get(timeout=self.fsync_seconds)
+            except queue.Empty:
+                item = None
+
+            # drain everything queued so far into one write.
+            lines = []
+            while item is not None:
+                if item is StopIteration:
+                    closing = True
+                    break
+                doc_id, doc = item
+                lines.append(
+                    json.dumps({"id": doc_id, "doc": doc}, ensure_ascii=False) + "\n"
+                )
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = None
+
+            try:
+                if lines:
+                    self.file.write("".join(lines))
+                    self.file.flush()
+                    self.written += len(lines)
+                    unsynced += len(lines)
+
+                now = time.monotonic()
+                if unsynced and (
+                    closing
+                    or unsynced >= self.fsync_every
+                    or now - last_sync >= self.fsync_seconds
+                ):
+                    os.fsync(self.file.fileno())
+                    unsynced = 0
+                    last_sync = now
+            except Exception as e:
+                self.error = e
+                if self.logger:
+                    self.logger.exception(f"Error writing checkpoint log {self.path}: {e}")
+                return
+
+    def close(self):
+        """
+        Write everything still queued, fsync and close the file.
+        """
+        self.queue.put(StopIteration)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise RuntimeError(f"Checkpoint log writer failed: {self.error}")
+
+
+def load_checkpoint_log(path: str, logger=None) -> dict:
+    """
+    Load the docs of a checkpoint log, later lines win.
+    A line cut off by a crash is skipped.
+    returns
+        - dict: {doc_id: doc}
+    """
+    docs = {}
+    if not os.path.exists(path):
+        return docs
+
+    skipped = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                skipped += 1
+                continue
+            docs[entry["id"]] = entry["doc"]
+
+    if logger:
+        logger.info(f"Loaded {len(docs)} docs from checkpoint log {path}.")
+        if skipped:
+            logger.warning(f"Skipped {skipped} incomplete lines in {path}.")
+    return docs
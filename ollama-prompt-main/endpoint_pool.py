@@ -0,0 +1,162 @@
+import threading
+import time
+
+import ollama
+
+"""
+Pool of Ollama servers, e.g. one per GPU. Requests go to the healthy
+endpoint with the fewest requests outstanding. Endpoints that keep
+failing are ejected for a while, then re-admitted after one successful
+trial request.
+"""
+
+
+class Endpoint:
+    """
+    Class to hold the clients and counters of one Ollama server.
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.client = ollama.Client(host)
+        self.async_client = None  # created by EndpointPool.open_async().
+
+        self.outstanding = 0
+        self.completed = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.total_latency = 0.0
+        self.ejected_until = None  # None while the endpoint is healthy.
+        self.trial_running = False
+
+    def stats(self, elapsed: float) -> dict:
+        return {
+            "healthy": self.ejected_until is None,
+            "completed": self.completed,
+            "errors": self.errors,
+            "requests_per_sec": self.completed / elapsed if elapsed > 0 else 0.0,
+            "avg_latency": (
+                self.total_latency / self.completed if self.completed else None
+            ),
+        }
+
+
+class EndpointPool:
+    """
+    Class to spread requests over several Ollama servers.
+        - acquire() picks the healthy endpoint with the fewest requests
+          outstanding and release() records the outcome.
+        - after max_errors errors in a row an endpoint is ejected for
+          eject_seconds. Then a single trial request is let through,
+          and the endpoint is re-admitted if it succeeds.
+        - if every endpoint is ejected, the one that is due first is used
+          anyway, so requests never stall.
+    """
+
+    def __init__(
+        self,
+        hosts: list[str],
+        max_errors: int = 3,
+        eject_seconds: float = 30.0,
+        logger=None,
+    ):
+        if not hosts:
+            raise ValueError("EndpointPool needs at least one host.")
+        self.endpoints = [Endpoint(host) for host in hosts]
+        self.max_errors = max_errors
+        self.eject_seconds = eject_seconds
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+
+    def open_async(self):
+        """
+        Create the async clients, inside the event loop that will use them.
+        """
+        for endpoint in self.endpoints:
+            endpoint.async_client = ollama.AsyncClient(endpoint.host)
+
+    def check_health(self):
+        """
+        Ping every endpoint (/api/tags) and eject the ones that don't answer.
+        """
+        for endpoint in self.endpoints:
+            try:
+                endpoint.client.list()
+            except Exception as e:
+                with self.lock:
+                    self._eject(endpoint, f"health check failed: {e}")
+
+    def acquire(self) -> Endpoint:
+        """
+        Pick the endpoint for the next request.
+        """
+        with self.lock:
+            now = time.monotonic()
+            healthy = [e for e in self.endpoints if e.ejected_until is None]
+
+            # let one trial request through to ejected endpoints that are due.
+            for endpoint in self.endpoints:
+                if (
+                    endpoint.ejected_until is not None
+                    and endpoint.ejected_until <= now
+                    and not endpoint.trial_running
+                ):
+                    endpoint.trial_running = True
+                    endpoint.outstanding += 1
+                    return endpoint
+
+            if healthy:
+                endpoint = min(healthy, key=lambda e: e.outstanding)
+            else:
+                endpoint = min(self.endpoints, key=lambda e: e.ejected_until)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, latency: float, error: bool = False):
+        """
+        Record the outcome of a request sent to an endpoint.
+        """
+        with self.lock:
+            endpoint.outstanding -= 1
+            trial = endpoint.trial_running
+            endpoint.trial_running = False
+
+            if error:
+                endpoint.errors += 1
+                endpoint.consecutive_errors += 1
+                if trial or (
+                    endpoint.ejected_until is None
+                    and endpoint.consecutive_errors >= self.max_errors
+                ):
+                    self._eject(
+                        endpoint, f"{endpoint.consecutive_errors} errors in a row"
+                    )
+                return
+
+            endpoint.completed += 1
+            endpoint.total_latency += latency
+            endpoint.consecutive_errors = 0
+            if endpoint.ejected_until is not None:
+                endpoint.ejected_until = None
+                if self.logger:
+                    self.logger.info(f"Endpoint {endpoint.host} re-admitted.")
+
+    def _eject(self, endpoint: Endpoint, reason: str):
+        """
+        Take an endpoint out of rotation. Called with the lock held.
+        """
+        endpoint.ejected_until = time.monotonic() + self.eject_seconds
+        if self.logger:
+            self.logger.warning(
+                f"Endpoint {endpoint.host} ejected for {self.eject_seconds}s "
+                f"({reason})."
+            )
+
+    def stats(self) -> dict:
+        """
+        Per endpoint throughput since the pool was created.
+        """
+        elapsed = time.perf_counter() - self.start_time
+        with self.lock:
+            return {e.host: e.stats(elapsed) for e in self.endpoints}
@@ -0,0 +1,258 @@
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Local stand-in for an Ollama server, to measure the annotation engines
+without a GPU. /api/chat answers every request with a JSON object built
+from the request's format schema (batch schemas included), after a
+latency drawn from a configurable distribution. It can also be run on
+its own and used as --host/--port of run.py.
+"""
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # a deep listen backlog, so bursts of connections aren't dropped and
+    # retried by TCP a second later.
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class MockOllamaServer:
+    """
+    Class to serve /api/chat and /api/tags from a background thread.
+        - latency is "constant", "uniform", "exponential" or "lognormal",
+          with mean latency_ms. latency_spread is the relative half width
+          of uniform and the sigma of lognormal.
+        - max_parallel requests are served at once, like
+          OLLAMA_NUM_PARALLEL, the others wait in line.
+        - invalid_rate of the answers don't match the schema and
+          error_rate of the requests get a 500.
+    """
+
+    def __init__(
+        self,
+        port: int = 0,
+        latency: str = "constant",
+        latency_ms: float = 200.0,
+        latency_spread: float = 0.5,
+        max_parallel: int = 4,
+        invalid_rate: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        if latency not in ["constant", "uniform", "exponential", "lognormal"]:
+            raise ValueError(f"Unknown latency distribution: {latency}")
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_spread = latency_spread
+        self.invalid_rate = invalid_rate
+        self.error_rate = error_rate
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(max_parallel)
+        self.counts = {"requests": 0, "errors": 0, "invalid": 0}
+        self.waiting = 0
+        self.peak_waiting = 0
+
+        self.server = MockHTTPServer(("127.0.0.1", port), self.get_handler())
+        self.thread = None
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.server.server_port}"
+
+    def start(self) -> str:
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.host
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def draw(self) -> tuple:
+        """
+        Draw the service time in seconds and the fate of a request.
+        """
+        mean = self.latency_ms / 1000
+        with self.lock:
+            if self.latency == "uniform":
+                spread = mean * self.latency_spread
+                seconds = self.rng.uniform(mean - spread, mean + spread)
+            elif self.latency == "exponential":
+                seconds = self.rng.expovariate(1 / mean) if mean > 0 else 0.0
+            elif self.latency == "lognormal":
+                sigma = self.latency_spread
+                mu = math.log(mean) - sigma**2 / 2 if mean > 0 else 0.0
+                seconds = self.rng.lognormvariate(mu, sigma) if mean > 0 else 0.0
+            else:
+                seconds = mean
+            error = self.rng.random() < self.error_rate
+            invalid = self.rng.random() < self.invalid_rate
+        return max(0.0, seconds), error, invalid
+
+    def make_value(self, name: str, schema: dict, defs: dict, prompt: str):
+        """
+        A value matching a JSON schema node. Arrays of objects with an id
+        get one item per "### N" request of a batch prompt.
+        """
+        if "$ref" in schema:
+            schema = defs[schema["$ref"].split("/")[-1]]
+        if "enum" in schema:
+            return self.rng.choice(schema["enum"])
+
+        kind = schema.get("type")
+        if kind == "object":
+            return {
+                key: self.make_value(key, value, defs, prompt)
+                for key, value in schema.get("properties", {}).items()
+            }
+        if kind == "array":
+            numbers = re.findall(r"^### (\d+)$", prompt, re.MULTILINE) or ["1"]
+            items = []
+            for number in numbers:
+                item = self.make_value(name, schema.get("items", {}), defs, prompt)
+                if isinstance(item, dict) and "id" in item:
+                    item["id"] = number
+                items.append(item)
+            return items
+        if kind == "boolean":
+            return self.rng.random() < 0.5
+        if kind == "integer":
+            return self.rng.randint(0, 10)
+        if kind == "number":
+            return round(self.rng.random(), 2)
+        if name == "label":
+            return self.rng.choice(["Othering", "None"])
+        return f"mock {name}"
+
+    def answer(self, request: dict) -> dict:
+        """
+        The /api/chat response to a request, with Ollama's timing fields.
+        """
+        seconds, error, invalid = self.draw()
+        with self.lock:
+            self.counts["requests"] += 1
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+
+        with self.slots:
+            with self.lock:
+                self.waiting -= 1
+            time.sleep(seconds)
+
+        if error:
+            with self.lock:
+                self.counts["errors"] += 1
+            return None
+
+        prompt = request["messages"][-1]["content"]
+        schema = request.get("format")
+        if invalid or not isinstance(schema, dict):
+            with self.lock:
+                self.counts["invalid"] += int(invalid)
+            content = "not json"
+        else:
+            with self.lock:
+                value = self.make_value("", schema, schema.get("$defs", {}), prompt)
+            content = json.dumps(value)
+
+        prompt_chars = sum(len(m["content"]) for m in request["messages"])
+        nanoseconds = int(seconds * 1e9)
+        return {
+            "model": request.get("model"),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": nanoseconds,
+            "load_duration": 0,
+            "prompt_eval_count": prompt_chars // 4,
+            "prompt_eval_duration": nanoseconds // 10,
+            "eval_count": len(content) // 4,
+            "eval_duration": nanoseconds - nanoseconds // 10,
+        }
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {**self.counts, "peak_waiting": self.peak_waiting}
+
+    def get_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep connections alive, like Ollama.
+            # headers and body are written separately, don't let Nagle's
+            # algorithm hold the body back on a kept-alive connection.
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, code: int, body: dict):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self.send_json(200, {"models": []})
+                else:
+                    self.send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                if self.path != "/api/chat":
+                    self.send_json(404, {"error": "not found"})
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                response = server.answer(request)
+                if response is None:
+                    self.send_json(500, {"error": "mock server error"})
+                else:
+                    self.send_json(200, response)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a mock Ollama server.")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument(
+        "--latency",
+        choices=["constant", "uniform", "exponential", "lognormal"],
+        default="lognormal",
+    )
+    parser.add_argument("--latency_ms", type=float, default=200.0)
+    parser.add_argument("--latency_spread", type=float, default=0.5)
+    parser.add_argument("--max_parallel", type=int, default=4)
+    parser.add_argument("--invalid_rate", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mock = MockOllamaServer(
+        port=args.port,
+        latency=args.latency,
+        latency_ms=args.latency_ms,
+        latency_spread=args.latency_spread,
+        max_parallel=args.max_parallel,
+        invalid_rate=args.invalid_rate,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    print(f"Mock Ollama server on http://{mock.host}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        print(mock.stats())
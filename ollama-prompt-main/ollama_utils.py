@@ -3,11 +3,21 @@ import time
 import os
 import argparse
 
-import concurrent
+import asyncio
+import concurrent.futures
+import json
+import threading
 import ollama
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError, create_model
 
 from utils import get_logger, save_file, load_file
+from response_cache import ResponseCache
+from adaptive_limiter import AdaptiveLimiter
+from endpoint_pool import EndpointPool
+from checkpoint_log import CheckpointLog, load_checkpoint_log
+from resume_index import ResumeIndex
+from retry_policy import TRANSPORT, DeferredQueue, classify_error
+from self_consistency import SelfConsistencyVote, get_sample_options, parse_variant
 
 """
 Utility functions for annotating data with an LLM.
@@ -74,13 +84,26 @@ class OllamaClient:
     class Messages:
         """
         Class to handle the messages for the LLM.
+        If demo_turns are given, the system prompt and the demos are sent
+        as chat turns, a byte-identical prefix for every doc, so the server
+        can reuse its KV cache. Otherwise the demos are glued to each doc
+        in one user turn.
         """
 
-        def __init__(self, system_prompt: str, user_head_prompt: str):
+        def __init__(
+            self, system_prompt: str, user_head_prompt: str, demo_turns: list = None
+        ):
             self.system_prompt = system_prompt
             self.head_user_prompt = user_head_prompt
+            self.prefix = None
+            if demo_turns is not None:
+                self.prefix = [{"role": "system", "content": system_prompt}]
+                self.prefix.extend(demo_turns)
 
         def add_doc_prompt(self, doc_prompt: str):
+            if self.prefix is not None:
+                return self.prefix + [{"role": "user", "content": doc_prompt}]
+
             to_process = [
                 {"role": "system", "content": self.system_prompt},
                 {
@@ -90,6 +113,51 @@ class OllamaClient:
             ]
             return to_process
 
+    class Timings:
+        """
+        Class to sum up the durations Ollama reports for each request.
+        prompt_eval_count only counts prompt tokens that were not in the
+        KV cache, so it shows whether the prefix is reused.
+        """
+
+        FIELDS = [
+            "prompt_eval_count",
+            "prompt_eval_duration",
+            "eval_count",
+            "eval_duration",
+            "load_duration",
+            "total_duration",
+        ]
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.requests = 0
+            self.totals = dict.fromkeys(self.FIELDS, 0)
+
+        def record(self, response):
+            with self.lock:
+                self.requests += 1
+                for field in self.FIELDS:
+                    self.totals[field] += getattr(response, field, None) or 0
+
+        def stats(self) -> dict:
+            with self.lock:
+                n = max(self.requests, 1)
+                totals = self.totals
+                return {
+                    "requests": self.requests,
+                    "avg_prompt_tokens_evaluated": totals["prompt_eval_count"] / n,
+                    "avg_prompt_eval_ms": totals["prompt_eval_duration"] / n / 1e6,
+                    "avg_eval_tokens": totals["eval_count"] / n,
+                    "eval_tokens_per_sec": (
+                        totals["eval_count"] / (totals["eval_duration"] / 1e9)
+                        if totals["eval_duration"]
+                        else 0.0
+                    ),
+                    "load_seconds": totals["load_duration"] / 1e9,
+                    "avg_total_ms": totals["total_duration"] / n / 1e6,
+                }
+
     def __init__(
         self,
         host,
@@ -101,39 +169,83 @@ class OllamaClient:
         user_head_prompt,
         logger,
         answer_schema,
+        cache: ResponseCache = None,
+        endpoints: list[str] = None,
+        demo_turns: list = None,
+        keep_alive=None,
     ):
         self.logger = logger
-        server_host = f"{host}:{port}"
-        self.client = ollama.Client(server_host)
+
+        # one or more servers, e.g. one per GPU.
+        hosts = endpoints if endpoints else [f"{host}:{port}"]
+        self.pool = EndpointPool(hosts, logger=logger)
+        if len(hosts) > 1:
+            self.pool.check_health()
 
         self.model = model
         self.seed = seed
         self.temperature = temperature
 
         self.options: ollama.Options = {"seed": seed, "temperature": temperature}
+        # how long the server keeps the model loaded, seconds or a duration ("30m").
+        try:
+            keep_alive = float(keep_alive)
+        except (TypeError, ValueError):
+            pass
+        self.keep_alive = keep_alive
+        self.timings = self.Timings()
 
         # set the messages for client.
-        self.messages = self.Messages(system_prompt, user_head_prompt)
+        self.messages = self.Messages(system_prompt, user_head_prompt, demo_turns)
 
         self.AnswerSchema = answer_schema
+        self.BatchSchema = None  # list schema for batched docs, see get_batch_schema().
+        self.BatchItemSchema = None  # one answer of a batch, with its id.
+        self.cache = cache
+        self.json_schemas = {}  # answer schema -> its json schema, built once.
 
-    def chat(self, doc_prompt: str):
+    def open_async(self):
         """
-        Chat with the LLM and check the response.
+        Create the async clients, inside the event loop that will use them.
         """
-        to_process = self.messages.add_doc_prompt(doc_prompt)
+        self.pool.open_async()
 
-        response = self.client.chat(
-            self.model,
-            messages=to_process,
-            options=self.options,
-            format=self.AnswerSchema.model_json_schema(),
-        )
+    def prepare_request(
+        self, doc_prompt: str, answer_schema=None, options: dict = None
+    ) -> tuple:
+        """
+        Build the messages and schema for a doc, and look them up in the cache.
+        options replace the client's options for this request only.
+        returns
+            - tuple: (messages, schema, cache_key, cached content or None)
+        """
+        answer_schema = answer_schema or self.AnswerSchema
+        options = options or self.options
+        to_process = self.messages.add_doc_prompt(doc_prompt)
+        if answer_schema not in self.json_schemas:
+            self.json_schemas[answer_schema] = answer_schema.model_json_schema()
+        schema = self.json_schemas[answer_schema]
+
+        cache_key, content = None, None
+        if self.cache is not None:
+            cache_key = self.cache.get_key(
+                self.model, to_process, dict(options), schema
+            )
+            content = self.cache.get(cache_key)
+        return to_process, schema, cache_key, content
 
+    def parse_response(self, content: str, cache_key: str = None, answer_schema=None):
+        """
+        Validate the response content against the schema. Valid responses
+        are cached if a cache_key is given.
+        """
+        answer_schema = answer_schema or self.AnswerSchema
         try:
-            response = self.AnswerSchema.model_validate_json(response.message.content)
+            response = answer_schema.model_validate_json(content)
             if response is not None:  # make the output serializable.
                 response = response.model_dump()
+            if cache_key is not None:
+                self.cache.put(cache_key, self.model, content)
             return response
 
         except Exception as e:
@@ -141,6 +253,255 @@ class OllamaClient:
             self.logger.exception("Invalid response. Please try again.")
             return None
 
+    def get_batch_schema(self):
+        """
+        Schema for K docs in one request: a list of answers, each with the
+        number of its doc as id.
+        """
+        if self.BatchSchema is None:
+            self.BatchItemSchema = create_model(
+                f"{self.AnswerSchema.__name__}_Item",
+                id=(str, ...),
+                **{
+                    name: (field.annotation, ...)
+                    for name, field in self.AnswerSchema.model_fields.items()
+                },
+            )
+            self.BatchSchema = create_model(
+                f"{self.AnswerSchema.__name__}_Batch",
+                answers=(list[self.BatchItemSchema], ...),
+            )
+        return self.BatchSchema
+
+    def get_batch_prompt(self, doc_prompts: list[str]) -> str:
+        """
+        Pack the doc prompts into one, numbered from 1.
+        """
+        numbered = [f"### {i}\n{doc_prompt}" for i, doc_prompt in enumerate(doc_prompts, 1)]
+        return (
+            f"Answer each of the {len(doc_prompts)} numbered requests below "
+            f"separately. Return one answer per request, with the number of "
+            f"the request as its id.\n\n" + "\n\n".join(numbered)
+        )
+
+    def split_batch(self, content: str, size: int, cache_key: str = None) -> list:
+        """
+        Split a batch response into the answers of its docs, in order.
+        Each answer is validated on its own, so one invalid answer doesn't
+        throw away the others. Invalid answers and missing, duplicate and
+        unknown ids are left as None. Responses with at least one valid
+        answer are cached if a cache_key is given.
+        """
+        answers = [None] * size
+        try:
+            items = json.loads(content)["answers"]
+            if not isinstance(items, list):
+                raise TypeError("answers is not a list")
+        except (ValueError, KeyError, TypeError) as e:
+            self.logger.warning(f"Invalid batch response: {e}")
+            return answers
+
+        self.get_batch_schema()
+        for item in items:
+            try:
+                answer = self.BatchItemSchema.model_validate(item).model_dump()
+            except ValidationError as e:
+                self.logger.warning(f"Invalid answer in batch response: {e}")
+                continue
+            doc_number = answer.pop("id").strip().lstrip("#").strip()
+            if doc_number.isdigit() and 1 <= int(doc_number) <= size:
+                if answers[int(doc_number) - 1] is None:
+                    answers[int(doc_number) - 1] = answer
+
+        if cache_key is not None and any(answer is not None for answer in answers):
+            self.cache.put(cache_key, self.model, content)
+        return answers
+
+    def parse(
+        self, content: str, cache_key: str, answer_schema, batch_size: int = None
+    ):
+        """
+        Parse the content of a single or, with batch_size, a batch request.
+        """
+        if batch_size is None:
+            return self.parse_response(content, cache_key, answer_schema)
+        return self.split_batch(content, batch_size, cache_key)
+
+    def get_chat_args(self, to_process: list, schema: dict, options: dict) -> dict:
+        return {
+            "messages": to_process,
+            "options": options or self.options,
+            "format": schema,
+            "keep_alive": self.keep_alive,
+        }
+
+    def finish_send(self, endpoint, start: float, response=None) -> str:
+        """
+        Give the endpoint back to the pool, with an error if there is no
+        response, and return the response content.
+        """
+        self.pool.release(endpoint, time.perf_counter() - start, error=response is None)
+        if response is None:
+            return None
+        self.timings.record(response)
+        return response.message.content
+
+    def send(self, to_process: list, schema: dict, options: dict = None) -> str:
+        """
+        Send the messages to an endpoint of the pool, return the response content.
+        """
+        endpoint = self.pool.acquire()
+        start = time.perf_counter()
+        try:
+            response = endpoint.client.chat(
+                self.model, **self.get_chat_args(to_process, schema, options)
+            )
+        except Exception:
+            self.finish_send(endpoint, start)
+            raise
+        return self.finish_send(endpoint, start, response)
+
+    async def asend(self, to_process: list, schema: dict, options: dict = None) -> str:
+        """
+        Async version of send.
+        """
+        endpoint = self.pool.acquire()
+        start = time.perf_counter()
+        try:
+            response = await endpoint.async_client.chat(
+                self.model, **self.get_chat_args(to_process, schema, options)
+            )
+        except Exception:
+            self.finish_send(endpoint, start)
+            raise
+        return self.finish_send(endpoint, start, response)
+
+    def chat(
+        self,
+        doc_prompt: str,
+        answer_schema=None,
+        options: dict = None,
+        batch_size: int = None,
+    ):
+        """
+        Chat with the LLM and check the response.
+        Valid responses are cached, so repeated calls skip the LLM.
+        """
+        to_process, schema, cache_key, content = self.prepare_request(
+            doc_prompt, answer_schema, options
+        )
+        if content is not None:
+            return self.parse(content, None, answer_schema, batch_size)
+
+        content = self.send(to_process, schema, options)
+        return self.parse(content, cache_key, answer_schema, batch_size)
+
+    async def achat(
+        self,
+        doc_prompt: str,
+        limiter: AdaptiveLimiter = None,
+        answer_schema=None,
+        options: dict = None,
+        batch_size: int = None,
+    ):
+        """
+        Async version of chat. Requests to the server wait for a slot of
+        the limiter, cache hits don't.
+        """
+        to_process, schema, cache_key, content = self.prepare_request(
+            doc_prompt, answer_schema, options
+        )
+        if content is not None:
+            return self.parse(content, None, answer_schema, batch_size)
+
+        if limiter is None:
+            content = await self.asend(to_process, schema, options)
+        else:
+            async with limiter.slot():
+                content = await self.asend(to_process, schema, options)
+        return self.parse(content, cache_key, answer_schema, batch_size)
+
+    def chat_batch(self, doc_prompts: list[str]) -> list:
+        """
+        Annotate several docs in one request.
+        returns
+            - list: the answer of each doc, None if it is missing or invalid.
+        """
+        return self.chat(
+            self.get_batch_prompt(doc_prompts),
+            self.get_batch_schema(),
+            batch_size=len(doc_prompts),
+        )
+
+    async def achat_batch(
+        self, doc_prompts: list[str], limiter: AdaptiveLimiter = None
+    ) -> list:
+        """
+        Async version of chat_batch.
+        """
+        return await self.achat(
+            self.get_batch_prompt(doc_prompts),
+            limiter,
+            self.get_batch_schema(),
+            batch_size=len(doc_prompts),
+        )
+
+
+class AnnotationRun:
+    """
+    Class to hold the state of one process_docs run, shared by the thread
+    and the async engine, which only differ in how they wait for units.
+        - store() keeps the answered docs of a unit and defers or fails
+          the docs whose request raised.
+        - next_batch() gives the deferred docs whose backoff has passed.
+        - finish() compacts the checkpoint log into the results.
+    """
+
+    def __init__(self, annotator: "Annotate", limiter: AdaptiveLimiter = None):
+        self.annotator = annotator
+        self.limiter = limiter
+        self.data, self.groups = annotator.prepare_docs()
+        self.annotated_docs = annotator.already_processed
+        self.log = annotator.open_log()
+        self.deferred = annotator.open_deferred()
+        self.main_pass = list(self.groups)
+        self.processed_count = 0
+        self.start_time = time.perf_counter()
+        self.pbar = tqdm(total=len(self.groups))
+
+    def store(self, docs: dict, errors: dict):
+        annotator = self.annotator
+        docs = annotator.collect_unit(docs, errors, self.deferred)
+        for doc_idx, doc in docs.items():
+            annotator.store_result(
+                self.annotated_docs, self.data, self.groups[doc_idx], doc, self.log
+            )
+            self.processed_count += 1
+            self.pbar.update(1)
+            if self.limiter is not None:
+                self.pbar.set_postfix(concurrency=self.limiter.concurrency)
+
+            if self.processed_count % annotator.config.save_interval == 0:
+                concurrency = ""
+                if self.limiter is not None:
+                    concurrency = f" (concurrency {self.limiter.concurrency})"
+                annotator.logger.info(
+                    f"Progress logged after processing {self.processed_count} docs"
+                    f"{concurrency}."
+                )
+
+    def next_batch(self, batch: list) -> list:
+        if self.deferred and batch is self.main_pass:
+            self.annotator.logger.info(
+                f"Main pass done, retrying {len(self.deferred)} deferred docs."
+            )
+        return self.deferred.pop_ready()
+
+    def finish(self):
+        self.pbar.close()
+        self.annotator.finish_results(self.annotated_docs, self.log)
+        self.annotator.log_run_stats(self.processed_count, self.start_time, self.limiter)
+
 
 class Annotate:
     """
@@ -157,6 +518,10 @@ class Annotate:
         logger=None,
         curr_iteration=0,
         otheringStage=0,
+        dedup=False,
+        docs=None,
+        prompt_file=None,
+        answer_schema=None,
     ):
         # set up logging.
         if logger is None:
@@ -165,6 +530,14 @@ class Annotate:
 
         logger.info("Setting Annotator variables and initializing Ollama client.")
         self.config = args
+        self.dedup = dedup  # annotate each distinct text only once.
+        self.batch_counts = {"batched": 0, "fallback": 0}
+        self.batch_lock = threading.Lock()
+
+        # temperature sweep: (temperature, seed) variants of every doc.
+        self.variants = [
+            parse_variant(value, args.seed) for value in (args.sweep or [])
+        ]
 
         # set the output filename if not provided.
         if args.out_filename is None:
@@ -176,7 +549,9 @@ class Annotate:
         self.results_path = results_path
 
         # load the data.
-        self.prompt_data, self.docs = self.load_data(script_path, data_path, stage)
+        self.prompt_data, self.docs = self.load_data(
+            script_path, data_path, stage, docs, prompt_file
+        )
 
         # check for existing results.
         self.already_processed, self.docs = self.handle_processed()
@@ -185,7 +560,9 @@ class Annotate:
         system_prompt = self.prompt_data["system_prompt"]
         user_head_prompt = self.get_user_head_prompt()
 
-        if otheringStage == 1:
+        if answer_schema is not None:  # name of a schema, e.g. from the stage DAG.
+            answer_schema = getattr(OllamaClient, answer_schema)
+        elif otheringStage == 1:
             answer_schema = OllamaClient.Answer_Identify_Target
         elif otheringStage == 2:
             answer_schema = OllamaClient.Answer_Is_Social_Group
@@ -198,6 +575,13 @@ class Annotate:
         else:
             answer_schema = OllamaClient.Answer
 
+        # open the response cache shared by all runs.
+        self.cache = None
+        if args.cache_path and not args.no_cache:
+            self.cache = ResponseCache(
+                args.cache_path, max_size_mb=args.cache_max_mb, logger=logger
+            )
+
         # initialize the ollama client.
         self.ollama_client = OllamaClient(
             args.host,
@@ -209,15 +593,28 @@ class Annotate:
             user_head_prompt,
             logger,
             answer_schema,
+            cache=self.cache,
+            endpoints=args.endpoints,
+            demo_turns=self.get_demo_turns() if args.prompt_layout == "turns" else None,
+            keep_alive=args.keep_alive,
         )
 
     def load_data(
-        self, script_path: str, dataset_path: str, stage: int
+        self,
+        script_path: str,
+        dataset_path: str,
+        stage: int,
+        docs: dict = None,
+        prompt_file: str = None,
     ) -> tuple[dict, dict]:
         """
         Load the prompt data and dataset from json.
+        The prompt file of the stage is used unless prompt_file is given,
+        and the dataset is only loaded if the docs are not given.
         """
-        if stage == 1:
+        if prompt_file is not None:
+            prompt_path = os.path.join(script_path, prompt_file)
+        elif stage == 1:
             prompt_path = os.path.join(script_path, self.config.prompt_file_stage_1)
         elif stage == 2:
             prompt_path = os.path.join(
@@ -258,33 +655,59 @@ class Annotate:
         
 
         prompt_data = load_file(prompt_path, logger=self.logger)
+        if docs is not None:
+            return prompt_data, docs
 
         dataset_file = os.path.join(dataset_path, self.config.dataset)
         dataset = load_file(dataset_file, logger=self.logger)
 
         return prompt_data, dataset
 
+    def get_log_path(self) -> str:
+        """
+        Path of the checkpoint log next to the results file.
+        """
+        out_name = os.path.splitext(self.config.out_filename)[0]
+        return os.path.join(self.results_path, f"{out_name}.log.jsonl")
+
+    def get_index_path(self) -> str:
+        """
+        Path of the resume index next to the results file.
+        """
+        out_name = os.path.splitext(self.config.out_filename)[0]
+        return os.path.join(self.results_path, f"{out_name}.index.json")
+
     def handle_processed(self) -> tuple[dict, dict]:
         """
-        Load docs that have already been processed and
-        remove them from the list of docs to process.
+        Find the docs that are already done with the resume index and
+        remove them from the list of docs to process. Docs whose annotation
+        failed are processed again until they used resume_attempts rounds.
+        returns
+            - tuple: (docs from the checkpoint log of an unfinished run,
+                      docs to process)
         """
-        # check for existing results.
+        self.index = ResumeIndex(self.get_index_path(), logger=self.logger)
         out_file_path = os.path.join(self.results_path, self.config.out_filename)
-        already_processed = {}
-        to_process = self.docs
-        if os.path.exists(out_file_path):
+        if not self.index.load() and os.path.exists(out_file_path):
+            # results of a run without an index.
             existing_data = load_file(out_file_path, logger=self.logger)
-            already_processed = existing_data["data"] if "data" in existing_data else {}
-            self.logger.info(f"Found {len(already_processed)} existing results.")
-
-            # remove already processed docs from the list.
-            to_process = {
-                doc_id: doc
-                for doc_id, doc in self.docs.items()
-                if doc_id not in already_processed.keys()
-            }
-
+            self.index.rebuild(existing_data.get("data", {}))
+            self.logger.info(f"Rebuilt resume index: {self.index.counts()}.")
+
+        # docs of an unfinished run, not compacted into the results yet.
+        already_processed = load_checkpoint_log(self.get_log_path(), logger=self.logger)
+        for doc_id, doc in already_processed.items():
+            self.index.record(doc_id, doc)
+
+        to_process = {
+            doc_id: doc
+            for doc_id, doc in self.docs.items()
+            if self.index.is_pending(doc_id, self.config.resume_attempts)
+        }
+        self.logger.info(
+            f"{len(self.docs) - len(to_process)} of {len(self.docs)} docs "
+            f"already processed, {len(to_process)} to process."
+        )
         return already_processed, to_process
 
     def get_user_head_prompt(self) -> str:
@@ -306,6 +729,22 @@ class Annotate:
 
         return head_user_prompt
 
+    def get_demo_turns(self) -> list[dict]:
+        """
+        The demos as user/assistant chat turns, formatted like the doc
+        prompts and the structured answers.
+        """
+        turns = []
+        for demo_item in self.prompt_data.get("demos", []):
+            turns.append({"role": "user", "content": self.get_doc_prompt(demo_item)})
+            turns.append(
+                {
+                    "role": "assistant",
+                    "content": json.dumps(demo_item["answer"], ensure_ascii=False),
+                }
+            )
+        return turns
+
     def format_doc(self, doc_data: dict) -> dict:
         """
         Format the doc data into an entry for processing.
@@ -318,41 +757,244 @@ class Annotate:
             entry["context"] = doc_data["context"]
         return entry
 
-    def annotate(self, doc_prompt: str) -> dict:
+    def annotate(self, doc_prompt: str, options: dict = None) -> dict:
         """
-        Annotate the messages with the LLM. Try multiple times if the response is invalid.
+        Annotate the messages with the LLM. Ask again right away if the
+        response is invalid. Request errors are raised, the caller picks
+        the retry policy from the kind of error.
         """
-        max_retries = self.config.max_retries
-        retry_count = 0
-        while retry_count < max_retries:
-            try:
-                annotation = self.ollama_client.chat(doc_prompt)
-                if annotation is not None:
-                    return annotation
-                else:  # retry if the response did not match the schema.
-                    retry_count += 1
+        for _ in range(self.config.max_retries):
+            annotation = self.ollama_client.chat(doc_prompt, options=options)
+            if annotation is not None:
+                return annotation
+        return None
 
-            except Exception as e:
-                self.logger.exception("Exception: " + str(e))
-                self.logger.exception("Ollama Error. Please try again.")
-                retry_count += 1
+    async def aannotate(
+        self, doc_prompt: str, limiter: AdaptiveLimiter, options: dict = None
+    ) -> dict:
+        """
+        Async version of annotate, the requests share the limiter's slots.
+        """
+        for _ in range(self.config.max_retries):
+            annotation = await self.ollama_client.achat(
+                doc_prompt, limiter, options=options
+            )
+            if annotation is not None:
+                return annotation
         return None
 
-    def process_doc(self, doc: dict) -> dict:
+    def open_vote(self, n_samples: int) -> SelfConsistencyVote:
         """
-        Process the doc with the LLM.
+        Vote on the label, or on the first answer field if there is none.
+        """
+        fields = list(self.ollama_client.AnswerSchema.model_fields)
+        vote_field = "label" if "label" in fields else fields[0]
+        return SelfConsistencyVote(n_samples, vote_field)
+
+    def get_wave_options(self, vote: SelfConsistencyVote) -> list[dict]:
+        """
+        Options of the samples of the next wave of a vote.
+        """
+        options = self.ollama_client.options
+        return [
+            get_sample_options(options, sample)
+            for sample in range(vote.used, vote.used + vote.get_wave_size())
+        ]
+
+    def annotate_samples(self, doc_prompt: str) -> dict:
+        """
+        Self-consistency: annotate the doc with several samples, each with
+        its own options, and return the majority answer. The samples of a
+        wave run in parallel, see SelfConsistencyVote.
+        """
+        vote = self.open_vote(self.config.samples)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=vote.n_samples) as executor:
+            while not vote.is_decided():
+                for answer in executor.map(
+                    lambda options: self.annotate(doc_prompt, options),
+                    self.get_wave_options(vote),
+                ):
+                    vote.add(answer)
+        return vote.result()
+
+    async def aannotate_samples(self, doc_prompt: str, limiter: AdaptiveLimiter) -> dict:
+        """
+        Async version of annotate_samples.
+        """
+        vote = self.open_vote(self.config.samples)
+        while not vote.is_decided():
+            for answer in await asyncio.gather(
+                *[
+                    self.aannotate(doc_prompt, limiter, options)
+                    for options in self.get_wave_options(vote)
+                ]
+            ):
+                vote.add(answer)
+        return vote.result()
+
+    def get_variant_options(self) -> list[dict]:
+        return [{**self.ollama_client.options, **variant} for variant in self.variants]
+
+    def combine_variants(self, answers: list) -> dict:
+        """
+        The majority answer of a sweep, with the answer of every variant.
+        """
+        vote = self.open_vote(len(answers))
+        for answer in answers:
+            vote.add(answer)
+        annotation = vote.result()
+        if annotation is not None:
+            annotation["variants"] = [
+                {**variant, "annotation": answer}
+                for variant, answer in zip(self.variants, answers)
+            ]
+        return annotation
+
+    def annotate_variants(self, doc_prompt: str) -> dict:
+        """
+        Temperature sweep: annotate the doc with every variant in parallel.
+        """
+        variant_options = self.get_variant_options()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(variant_options)
+        ) as executor:
+            answers = list(
+                executor.map(
+                    lambda options: self.annotate(doc_prompt, options), variant_options
+                )
+            )
+        return self.combine_variants(answers)
+
+    async def aannotate_variants(self, doc_prompt: str, limiter: AdaptiveLimiter) -> dict:
+        """
+        Async version of annotate_variants.
+        """
+        answers = await asyncio.gather(
+            *[
+                self.aannotate(doc_prompt, limiter, options)
+                for options in self.get_variant_options()
+            ]
+        )
+        return self.combine_variants(answers)
+
+    def annotate_doc(self, doc_prompt: str) -> dict:
+        """
+        Annotate a doc, with a temperature sweep if variants are given or
+        with self-consistency voting if samples > 1.
+        """
+        if self.variants:
+            return self.annotate_variants(doc_prompt)
+        if self.config.samples > 1:
+            return self.annotate_samples(doc_prompt)
+        return self.annotate(doc_prompt)
+
+    async def aannotate_doc(self, doc_prompt: str, limiter: AdaptiveLimiter) -> dict:
+        """
+        Async version of annotate_doc.
+        """
+        if self.variants:
+            return await self.aannotate_variants(doc_prompt, limiter)
+        if self.config.samples > 1:
+            return await self.aannotate_samples(doc_prompt, limiter)
+        return await self.aannotate(doc_prompt, limiter)
+
+    def get_doc_prompt(self, doc: dict) -> str:
+        """
+        Build the prompt for a doc.
         """
         context_str = ""
         if "context" in doc and doc["context"]:
             context_str = "\nContext keywords: " + ", ".join(doc["context"])
-        doc_prompt = (
-            self.prompt_data["question"] + "\nText: " + doc["text"] + context_str
-        )
-        annotation = self.annotate(doc_prompt)
+        return self.prompt_data["question"] + "\nText: " + doc["text"] + context_str
+
+    def process_doc(self, doc: dict) -> dict:
+        """
+        Process the doc with the LLM.
+        """
+        annotation = self.annotate_doc(self.get_doc_prompt(doc))
         doc["annotation"] = annotation
         return doc
 
-    def save_results(self, processed_data: dict):
+    async def aprocess_doc(self, doc: dict, limiter: AdaptiveLimiter) -> dict:
+        """
+        Async version of process_doc.
+        """
+        doc["annotation"] = await self.aannotate_doc(self.get_doc_prompt(doc), limiter)
+        return doc
+
+    def apply_batch_answers(self, docs: dict, answers: list) -> list:
+        """
+        Store the answers of a batch in its docs and count the docs
+        answered by their batch and the ones that fell back.
+        returns
+            - list: ids of the docs missing or invalid in the batch answer.
+        """
+        fallback_ids = []
+        for (doc_id, doc), answer in zip(docs.items(), answers):
+            if answer is None:
+                fallback_ids.append(doc_id)
+            else:
+                doc["annotation"] = answer
+        with self.batch_lock:
+            self.batch_counts["batched"] += len(docs) - len(fallback_ids)
+            self.batch_counts["fallback"] += len(fallback_ids)
+        return fallback_ids
+
+    @staticmethod
+    def split_unit(docs: dict, errors: dict) -> tuple[dict, dict]:
+        return {doc_id: doc for doc_id, doc in docs.items() if doc_id not in errors}, errors
+
+    def process_unit(self, doc_ids: list, data: dict) -> tuple[dict, dict]:
+        """
+        Process a unit of docs, in one request if there are several.
+        Docs missing from the batch answer are processed on their own, and
+        if one of those requests fails only that doc is returned as an error.
+        returns
+            - tuple: ({doc_id: doc}, {doc_id: error})
+        """
+        docs = {doc_id: dict(data[doc_id]) for doc_id in doc_ids}
+        if len(docs) == 1:
+            return {doc_id: self.process_doc(doc) for doc_id, doc in docs.items()}, {}
+
+        doc_prompts = {doc_id: self.get_doc_prompt(doc) for doc_id, doc in docs.items()}
+        answers = self.ollama_client.chat_batch(list(doc_prompts.values()))
+        errors = {}
+        for doc_id in self.apply_batch_answers(docs, answers):
+            try:
+                docs[doc_id]["annotation"] = self.annotate(doc_prompts[doc_id])
+            except Exception as e:
+                errors[doc_id] = e
+        return self.split_unit(docs, errors)
+
+    async def aprocess_unit(
+        self, doc_ids: list, data: dict, limiter: AdaptiveLimiter
+    ) -> tuple[dict, dict]:
+        """
+        Async version of process_unit, the fallback docs are sent at once.
+        """
+        docs = {doc_id: dict(data[doc_id]) for doc_id in doc_ids}
+        if len(docs) == 1:
+            return {
+                doc_id: await self.aprocess_doc(doc, limiter)
+                for doc_id, doc in docs.items()
+            }, {}
+
+        doc_prompts = {doc_id: self.get_doc_prompt(doc) for doc_id, doc in docs.items()}
+        answers = await self.ollama_client.achat_batch(list(doc_prompts.values()), limiter)
+        fallback_ids = self.apply_batch_answers(docs, answers)
+        results = await asyncio.gather(
+            *[self.aannotate(doc_prompts[doc_id], limiter) for doc_id in fallback_ids],
+            return_exceptions=True,
+        )
+        errors = {}
+        for doc_id, result in zip(fallback_ids, results):
+            if isinstance(result, Exception):
+                errors[doc_id] = result
+            else:
+                docs[doc_id]["annotation"] = result
+        return self.split_unit(docs, errors)
+
+    def save_results(self, processed_data: dict) -> bool:
         """
         Save the results and config details to a json file.
         """
@@ -362,21 +1004,78 @@ class Annotate:
         final_output["prompt_data"] = self.prompt_data
         final_output["data"] = processed_data
 
-        save_file(
+        return save_file(
             final_output,
             self.results_path,
             self.config.out_filename,
             logger=self.logger,
         )
 
-    def process_docs(self):
+    def open_log(self) -> CheckpointLog:
         """
-        Process the docs in parallel.
+        Open the checkpoint log that every finished doc is appended to.
         """
+        return CheckpointLog(
+            self.get_log_path(),
+            fsync_every=self.config.save_interval,
+            logger=self.logger,
+        )
+
+    def finish_results(self, annotated_docs: dict, log: CheckpointLog):
+        """
+        Close the checkpoint log and compact it into the results file.
+        The index is saved and the log removed only once the results
+        file is written.
+        """
+        log.close()
+
+        # results of the earlier runs, updated with this run.
+        out_file_path = os.path.join(self.results_path, self.config.out_filename)
+        results = {}
+        if os.path.exists(out_file_path):
+            results = load_file(out_file_path, logger=self.logger).get("data", {})
+        results.update(annotated_docs)
 
-        num_workers = self.config.workers
-        save_interval = self.config.save_interval
+        if self.save_results(results):
+            self.index.save()
+            os.remove(log.path)
+        self.logger.info(f"Resume index: {self.index.counts()}.")
+
+    def normalize_text(self, doc: dict) -> tuple:
+        """
+        Key of the docs that get the same annotation in dedup mode.
+        """
+        text = " ".join(doc["text"].split()).casefold()
+        return text, tuple(doc.get("context") or ())
+
+    def group_docs(self, data: dict) -> dict:
+        """
+        Group the docs to annotate. Each group is sent to the LLM once and
+        its annotation is copied to every doc in it.
+        returns
+            - dict: {representative_id: [doc_id, ...]}
+        """
+        if not self.dedup:
+            return {doc_id: [doc_id] for doc_id in data}
+
+        groups = {}
+        representatives = {}
+        for doc_id, doc in data.items():
+            key = self.normalize_text(doc)
+            representative_id = representatives.setdefault(key, doc_id)
+            groups.setdefault(representative_id, []).append(doc_id)
+
+        self.logger.info(
+            f"Dedup mode: {len(data)} docs collapse to {len(groups)} unique texts."
+        )
+        return groups
 
+    def prepare_docs(self) -> tuple[dict, dict]:
+        """
+        Format the docs and group them for annotation.
+        returns
+            - tuple: (formatted docs, {representative_id: [doc_id, ...]})
+        """
         self.logger.info("Formatting docs")
 
         data = {}  # dict to store formatted docs.
@@ -384,41 +1083,161 @@ class Annotate:
             entry = self.format_doc(doc_data)
             data[doc_id] = entry
 
-        annotated_docs = self.already_processed
-        total_docs = len(data)
+        return data, self.group_docs(data)
 
-        # Use a ThreadPoolExecutor for parallel processing
-        self.logger.info(f"Processing docs with {num_workers} workers.")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-            futures = {
-                executor.submit(self.process_doc, doc): doc_id
-                for doc_id, doc in data.items()
+    def store_result(
+        self,
+        annotated_docs: dict,
+        data: dict,
+        group_doc_ids: list,
+        doc: dict,
+        log: CheckpointLog,
+    ):
+        """
+        Copy the annotation of a processed doc to every doc of its group,
+        record them in the resume index and append them to the checkpoint log.
+        """
+        for group_doc_id in group_doc_ids:
+            annotated_docs[group_doc_id] = {
+                **data[group_doc_id],
+                "annotation": doc["annotation"],
             }
+            self.index.record(group_doc_id, annotated_docs[group_doc_id])
+            log.append(group_doc_id, annotated_docs[group_doc_id])
 
-            # Initialize tqdm progress bar to track doc processing
-            with tqdm(total=total_docs) as pbar:
-                processed_count = 0
-                # Process docs and save at regular intervals
+    def open_deferred(self) -> DeferredQueue:
+        """
+        Queue for the docs whose request failed with a transport error.
+        """
+        return DeferredQueue(
+            max_attempts=self.config.transport_retries,
+            base_delay=self.config.backoff_seconds,
+        )
+
+    def handle_error(self, error: Exception, doc_idx: str, deferred: DeferredQueue) -> bool:
+        """
+        Defer the doc if its error is worth retrying later.
+        returns
+            - bool: True if the doc was deferred, False if it failed.
+        """
+        if classify_error(error) == TRANSPORT and deferred.defer(doc_idx):
+            self.logger.warning(
+                f"Deferred doc {doc_idx} (attempt {deferred.attempts[doc_idx]}): {error}"
+            )
+            return True
+        self.logger.error(f"Error processing doc {doc_idx}: {error}")
+        return False
+
+    def get_units(self, doc_ids: list) -> list[list]:
+        """
+        Split the docs into the units sent to the LLM, batch_size docs each.
+        Docs are voted on one at a time in sweep and self-consistency mode.
+        """
+        voting = self.variants or self.config.samples > 1
+        size = 1 if voting else self.config.batch_size
+        return [doc_ids[i : i + size] for i in range(0, len(doc_ids), size)]
+
+    def collect_unit(self, docs: dict, errors: dict, deferred: DeferredQueue) -> dict:
+        """
+        The results of a unit. Each doc whose request raised is deferred
+        or failed, the answered docs are kept.
+        """
+        docs = dict(docs)
+        for doc_idx, error in errors.items():
+            if not self.handle_error(error, doc_idx, deferred):
+                docs[doc_idx] = {"annotation": None}
+        return docs
+
+    def log_run_stats(self, processed_count: int, start_time: float, limiter=None):
+        """
+        Log the throughput of the run and the stats of the client.
+        """
+        elapsed = time.perf_counter() - start_time
+        self.logger.info(
+            f"Annotated {processed_count} docs in {elapsed:.1f}s "
+            f"({processed_count / max(elapsed, 1e-9):.2f} docs/s, "
+            f"batch size {self.config.batch_size})."
+        )
+        if self.config.batch_size > 1:
+            self.logger.info(f"Batched answers: {self.batch_counts}")
+        if limiter is not None:
+            self.logger.info(f"Adaptive concurrency: {limiter.stats()}")
+        self.logger.info(f"Endpoints: {self.ollama_client.pool.stats()}")
+        self.logger.info(f"Request timings: {self.ollama_client.timings.stats()}")
+        if self.cache is not None:
+            self.logger.info(f"Response cache: {self.cache.stats()}")
+
+    def process_docs(self):
+        """
+        Process the docs in parallel. Docs that hit a transport error are
+        retried after the main pass, with backoff.
+        """
+        if self.config.engine == "async":
+            asyncio.run(self.process_docs_async())
+            return
+
+        run = AnnotationRun(self)
+        self.logger.info(f"Processing docs with {self.config.workers} workers.")
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.config.workers
+        ) as executor:
+            batch = run.main_pass
+            while batch or run.deferred:
+                if not batch:  # wait until the next deferred doc is ready.
+                    time.sleep(run.deferred.wait_time())
+                    batch = run.deferred.pop_ready()
+                    continue
+
+                futures = {
+                    executor.submit(self.process_unit, unit, run.data): unit
+                    for unit in self.get_units(batch)
+                }
+                # every finished doc is appended to the log.
                 for future in concurrent.futures.as_completed(futures):
-                    doc_idx = futures[future]
                     try:
-                        # Get the results of process_doc() for each doc
-                        doc = future.result()
-                        annotated_docs[doc_idx] = doc
-                        processed_count += 1
+                        docs, errors = future.result()
+                    except Exception as e:
+                        docs, errors = {}, dict.fromkeys(futures[future], e)
+                    run.store(docs, errors)
+                batch = run.next_batch(batch)
 
-                        # Update the progress bar
-                        pbar.update(1)
+        run.finish()
 
-                        # Save annotated_docs at regular intervals
-                        if processed_count % save_interval == 0:
-                            self.save_results(annotated_docs)
-                            self.logger.info(
-                                f"Progress saved after processing {processed_count} docs."
-                            )
+    async def process_docs_async(self):
+        """
+        Process the docs with the async client. The number of requests in
+        flight starts at workers and is tuned by an AdaptiveLimiter.
+        Docs that hit a transport error are retried after the main pass.
+        """
+        self.ollama_client.open_async()
+        limiter = AdaptiveLimiter(
+            initial=self.config.workers,
+            min_limit=self.config.min_concurrency,
+            max_limit=self.config.max_concurrency,
+            logger=self.logger,
+        )
+        run = AnnotationRun(self, limiter)
+        self.logger.info(
+            f"Processing docs with adaptive concurrency, starting at "
+            f"{limiter.concurrency} (max {limiter.max_limit})."
+        )
 
-                    except Exception as e:
-                        self.logger.exception(f"Error processing doc {doc_idx}: {e}")
+        async def process(unit: list) -> tuple[dict, dict]:
+            try:
+                return await self.aprocess_unit(unit, run.data, limiter)
+            except Exception as e:
+                return {}, dict.fromkeys(unit, e)
+
+        batch = run.main_pass
+        while batch or run.deferred:
+            if not batch:  # wait until the next deferred doc is ready.
+                await asyncio.sleep(run.deferred.wait_time())
+                batch = run.deferred.pop_ready()
+                continue
+
+            tasks = [asyncio.create_task(process(unit)) for unit in self.get_units(batch)]
+            for task in asyncio.as_completed(tasks):
+                run.store(*await task)
+            batch = run.next_batch(batch)
 
-        # Save the final results.
-        self.save_results(annotated_docs)
+        run.finish()
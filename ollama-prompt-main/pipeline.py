@@ -0,0 +1,278 @@
+import asyncio
+import copy
+import os
+import time
+
+from tqdm import tqdm
+
+from adaptive_limiter import AdaptiveLimiter
+from ollama_utils import Annotate
+from retry_policy import TRANSPORT, classify_error, get_backoff
+from utils import load_file, save_file
+
+"""
+Run annotation stages as a streaming pipeline instead of barriers.
+A doc that finishes one stage goes straight into the next one through a
+bounded queue, so the tail of a stage overlaps the head of the next and
+the GPUs stay busy across stage boundaries. Every stage still writes its
+own results file, checkpoint log and resume index.
+"""
+
+
+class PipelineStage:
+    """
+    Class to run one Annotate stage inside a pipeline.
+        - transform(doc_id, annotated_doc) builds the input of the next
+          stage from an annotated doc, or returns None to drop it.
+        - out_dataset, if given, is the file in results_path the inputs of
+          the next stage are saved to at the end, like the
+          stage_<N>_data files of the barrier runs.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        annotator: Annotate,
+        transform=None,
+        out_dataset: str = None,
+    ):
+        self.name = name
+        self.annotator = annotator
+        self.config = annotator.config
+        self.logger = annotator.logger
+        self.transform = transform
+        self.out_dataset = out_dataset
+
+        self.annotated_docs = annotator.already_processed
+        self.forwarded = {}  # inputs passed on to the next stage.
+        self.previous = None  # results of earlier runs, loaded when needed.
+        self.memo = {}  # dedup mode: normalized text -> annotation task.
+        self.counts = {"annotated": 0, "reused": 0, "failed": 0, "forwarded": 0}
+        self.log = None
+        self.pbar = None
+
+    def open(self, position: int, total: int = None):
+        self.annotator.ollama_client.open_async()
+        self.log = self.annotator.open_log()
+        self.pbar = tqdm(total=total, desc=self.name, position=position)
+        self.start_time = time.perf_counter()
+
+    def get_previous(self, doc_id: str) -> dict:
+        """
+        The result of a doc that an earlier run already annotated.
+        """
+        if self.previous is None:
+            out_file_path = os.path.join(
+                self.annotator.results_path, self.config.out_filename
+            )
+            self.previous = {}
+            if os.path.exists(out_file_path):
+                self.previous = load_file(out_file_path, logger=self.logger)["data"]
+            self.previous.update(self.annotator.already_processed)
+        return self.previous.get(doc_id)
+
+    async def request(self, entry: dict, limiter: AdaptiveLimiter) -> dict:
+        """
+        Annotate one doc. Transport errors are retried after a backoff,
+        only this doc waits, the other workers go on.
+        """
+        doc_prompt = self.annotator.get_doc_prompt(entry)
+        attempt = 0
+        while True:
+            try:
+                return await self.annotator.aannotate_doc(doc_prompt, limiter)
+            except Exception as e:
+                attempt += 1
+                if (
+                    classify_error(e) != TRANSPORT
+                    or attempt > self.config.transport_retries
+                ):
+                    self.logger.error(f"{self.name}: error processing doc: {e}")
+                    return None
+                self.logger.warning(f"{self.name}: retrying doc (attempt {attempt}): {e}")
+                await asyncio.sleep(get_backoff(attempt, self.config.backoff_seconds))
+
+    async def annotate_doc(self, doc_id: str, doc: dict, limiter: AdaptiveLimiter):
+        """
+        Annotate a doc, or reuse its result if an earlier run finished it.
+        """
+        annotator = self.annotator
+        if not annotator.index.is_pending(doc_id, self.config.resume_attempts):
+            previous = self.get_previous(doc_id)
+            if previous is not None:
+                self.counts["reused"] += 1
+                return previous
+
+        entry = annotator.format_doc(doc)
+        if annotator.dedup:  # docs with the same text share one request.
+            key = annotator.normalize_text(entry)
+            if key not in self.memo:
+                self.memo[key] = asyncio.ensure_future(self.request(entry, limiter))
+            annotation = await self.memo[key]
+        else:
+            annotation = await self.request(entry, limiter)
+
+        self.counts["annotated" if annotation is not None else "failed"] += 1
+        annotator.store_result(
+            self.annotated_docs, {doc_id: entry}, [doc_id], {"annotation": annotation}, self.log
+        )
+        return self.annotated_docs[doc_id]
+
+    async def worker(
+        self, in_queue: asyncio.Queue, out_queue: asyncio.Queue, limiter: AdaptiveLimiter
+    ):
+        """
+        Take docs from the input queue until a None arrives, annotate them
+        and pass the inputs for the next stage on.
+        """
+        while True:
+            item = await in_queue.get()
+            if item is None:
+                return
+            doc_id, doc = item
+            try:
+                result = await self.annotate_doc(doc_id, doc, limiter)
+            except Exception as e:
+                self.logger.exception(f"{self.name}: error processing doc {doc_id}: {e}")
+                continue
+            self.pbar.update(1)
+
+            if self.transform is None or out_queue is None:
+                continue
+            next_doc = self.transform(doc_id, result)
+            if next_doc is not None:
+                self.forwarded[doc_id] = next_doc
+                self.counts["forwarded"] += 1
+                await out_queue.put((doc_id, next_doc))
+
+    def finish(self):
+        """
+        Compact the stage's results and save the inputs it passed on.
+        """
+        self.pbar.close()
+        self.annotator.finish_results(self.annotated_docs, self.log)
+        if self.out_dataset is not None:
+            save_file(
+                self.forwarded,
+                self.annotator.results_path,
+                self.out_dataset,
+                logger=self.logger,
+            )
+        elapsed = time.perf_counter() - self.start_time
+        self.logger.info(f"{self.name}: {self.counts} in {elapsed:.1f}s.")
+
+
+class Pipeline:
+    """
+    Class to chain stages with bounded queues. Each stage runs workers
+    coroutines. All stages share one AdaptiveLimiter, so the requests in
+    flight are tuned for the server, not per stage.
+    """
+
+    def __init__(self, stages: list[PipelineStage], config, logger):
+        self.stages = stages
+        self.config = config
+        self.logger = logger
+        self.workers = config.max_concurrency
+        self.queue_size = config.queue_size
+
+    async def run(self, docs: dict):
+        """
+        Feed the docs into the first stage and wait for the last one.
+        """
+        limiter = AdaptiveLimiter(
+            initial=self.config.workers,
+            min_limit=self.config.min_concurrency,
+            max_limit=self.config.max_concurrency,
+            logger=self.logger,
+        )
+        for i, stage in enumerate(self.stages):
+            stage.open(position=i, total=len(docs) if i == 0 else None)
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        async def feed():
+            for doc_id, doc in docs.items():
+                await queues[0].put((doc_id, doc))
+            for _ in range(self.workers):
+                await queues[0].put(None)
+
+        async def run_stage(i: int):
+            out_queue = queues[i + 1] if i + 1 < len(self.stages) else None
+            await asyncio.gather(
+                *[
+                    self.stages[i].worker(queues[i], out_queue, limiter)
+                    for _ in range(self.workers)
+                ]
+            )
+            if out_queue is not None:  # tell the next stage it is done.
+                for _ in range(self.workers):
+                    await out_queue.put(None)
+
+        await asyncio.gather(feed(), *[run_stage(i) for i in range(len(self.stages))])
+
+        for stage in self.stages:
+            stage.finish()
+        self.logger.info(f"Adaptive concurrency: {limiter.stats()}")
+
+
+def run_othering_pipeline(
+    args, script_path, data_path, result_path, curr_iteration, original_dataset, logger
+):
+    """
+    Stages 6 (identify target) -> 7 (is social group) -> 8 (othering) of
+    run.py as one pipeline over the original dataset. Writes the same
+    results and stage_<N>_data files as the barrier runs.
+    """
+    original_data = load_file(os.path.join(data_path, original_dataset), logger=logger)
+
+    def make_annotator(out_filename, stage, otheringStage, dedup=False):
+        stage_args = copy.copy(args)
+        stage_args.out_filename = out_filename
+        return Annotate(
+            stage_args,
+            script_path,
+            data_path,
+            result_path,
+            stage=stage,
+            logger=logger,
+            curr_iteration=curr_iteration,
+            otheringStage=otheringStage,
+            dedup=dedup,
+            docs={},
+        )
+
+    def get_target(doc_id, doc):
+        annotation = doc.get("annotation")
+        if annotation and "target" in annotation:
+            return {"text": annotation["target"]}
+        return None
+
+    def get_possible_case(doc_id, doc):
+        annotation = doc.get("annotation")
+        if (
+            isinstance(annotation, dict)
+            and annotation.get("isSocialGroup") in [True, "True", "true"]
+            and doc_id in original_data
+        ):
+            return {"text": original_data[doc_id]["text"]}
+        return None
+
+    stages = [
+        PipelineStage(
+            "stage 6",
+            make_annotator(f"6_target_results_{curr_iteration}.json", 6, 1),
+            transform=get_target,
+            out_dataset=f"stage_6_data_{curr_iteration}.json",
+        ),
+        PipelineStage(
+            "stage 7",
+            make_annotator(f"stage_7_results_{curr_iteration}.json", 7, 2, dedup=True),
+            transform=get_possible_case,
+            out_dataset=f"stage_7_data_{curr_iteration}.json",
+        ),
+        PipelineStage(
+            "stage 8",
+            make_annotator(f"stage_8_results_{curr_iteration}_othering.json", 10, 6),
+        ),
+    ]
+    asyncio.run(Pipeline(stages, args, logger).run(original_data))
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+"""
+Disk-backed cache of LLM responses, shared by every run and iteration.
+Responses are keyed by the model, the full message list, the sampling
+options and the answer schema, so only calls that changed reach Ollama.
+"""
+
+
+class ResponseCache:
+    """
+    Class to store LLM responses in a SQLite database.
+    The least recently used responses are evicted once the
+    stored responses grow past max_size_mb.
+    """
+
+    def __init__(self, path: str, max_size_mb: float = 1024, logger=None):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.logger = logger
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # one connection shared by the annotation threads, guarded by a lock.
+        # WAL lets several jobs read and write the same cache file.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT,
+                size INTEGER,
+                created REAL,
+                last_used REAL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self.conn.commit()
+        self.size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+        if logger:
+            logger.info(
+                f"Response cache at {path} ({self.size / 1024 / 1024:.1f} MB used)."
+            )
+
+    @staticmethod
+    def get_key(model: str, messages: list, options: dict, schema: dict) -> str:
+        """
+        Hash everything that decides the response.
+        """
+        request = json.dumps(
+            {
+                "model": model,
+                "messages": messages,
+                "options": options,
+                "schema": schema,
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str:
+        """
+        Get the cached response content, or None on a miss.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key: str, model: str, response: str):
+        """
+        Store a response content and evict old responses if the cache is full.
+        """
+        size = len(response.encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, now, now),
+            )
+            self.size += size - (old[0] if old else 0)
+            if self.size > self.max_size:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        """
+        Drop the least recently used responses until the cache is
+        back under 90% of its max size. Called with the lock held.
+        """
+        target = int(self.max_size * 0.9)
+        rows = self.conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        )
+        to_delete = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            to_delete.append((key,))
+            self.size -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+        self.evicted += len(to_delete)
+
+    def stats(self) -> dict:
+        """
+        Hit/miss counters of this process.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+            "size_mb": self.size / 1024 / 1024,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
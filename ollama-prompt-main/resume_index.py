@@ -0,0 +1,84 @@
+import json
+import os
+
+"""
+Resume index of an annotation run, kept next to its results file.
+It maps each doc id to its status and the number of times it was
+annotated, so a resumed run knows what is left without loading the
+results, and retries the docs whose annotation failed.
+"""
+
+DONE = "done"
+FAILED = "failed"
+
+
+class ResumeIndex:
+    """
+    Class to track {doc_id: [status, attempts]} for a results file.
+    attempts counts annotation rounds, each with its own max_retries.
+    """
+
+    def __init__(self, path: str, logger=None):
+        self.path = path
+        self.logger = logger
+        self.entries = {}
+
+    @staticmethod
+    def get_status(doc: dict) -> str:
+        """
+        A doc failed if all retries ended without a valid annotation.
+        """
+        return DONE if doc.get("annotation") is not None else FAILED
+
+    def load(self) -> bool:
+        """
+        Load the index, returns False if there is none yet.
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r") as f:
+            self.entries = json.load(f)
+        if self.logger:
+            self.logger.info(f"Loaded resume index {self.path}: {self.counts()}.")
+        return True
+
+    def rebuild(self, docs: dict):
+        """
+        Build the index from existing results, e.g. of a run without one.
+        """
+        for doc_id, doc in docs.items():
+            self.entries[doc_id] = [self.get_status(doc), 1]
+
+    def record(self, doc_id: str, doc: dict):
+        """
+        Record one more annotation round of a doc.
+        """
+        attempts = self.entries[doc_id][1] if doc_id in self.entries else 0
+        self.entries[doc_id] = [self.get_status(doc), attempts + 1]
+
+    def is_pending(self, doc_id: str, max_attempts: int) -> bool:
+        """
+        A doc still has to be annotated if it is new, or if it failed and
+        has attempts left.
+        """
+        if doc_id not in self.entries:
+            return True
+        status, attempts = self.entries[doc_id]
+        return status == FAILED and attempts < max_attempts
+
+    def counts(self) -> dict:
+        counts = {DONE: 0, FAILED: 0}
+        for status, _ in self.entries.values():
+            counts[status] += 1
+        return counts
+
+    def save(self):
+        """
+        Write the index, replacing the old one only once it is complete.
+        """
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
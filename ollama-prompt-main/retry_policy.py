@@ -0,0 +1,94 @@
+import heapq
+import random
+import time
+
+import httpx
+import ollama
+
+"""
+Retry policies for annotation requests, chosen by the kind of error.
+    - schema: the response did not match the answer schema, ask again
+      right away (handled in Annotate.annotate).
+    - transport: connection errors, timeouts and server errors. The doc
+      is deferred and retried after the main pass, with exponential
+      backoff and jitter, so a struggling server doesn't hold up workers.
+    - fatal: anything else (e.g. an unknown model), not retried.
+"""
+
+TRANSPORT = "transport"
+FATAL = "fatal"
+
+
+def classify_error(error: Exception) -> str:
+    """
+    Get the retry policy for an error raised by the Ollama client.
+    """
+    if isinstance(error, ollama.ResponseError):
+        if error.status_code >= 500 or error.status_code == 429:
+            return TRANSPORT
+        return FATAL
+    if isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return TRANSPORT
+    return FATAL
+
+
+def get_backoff(attempt: int, base_delay: float = 2.0, max_delay: float = 60.0) -> float:
+    """
+    Delay before retry number attempt, drawn from
+    [0, min(max_delay, base_delay * 2^(attempt-1))] (full jitter).
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+class DeferredQueue:
+    """
+    Class to hold docs whose request failed with a transport error until
+    their backoff has passed, see get_backoff().
+    """
+
+    def __init__(
+        self, max_attempts: int = 5, base_delay: float = 2.0, max_delay: float = 60.0
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempts = {}
+        self.heap = []  # (ready_at, seq, doc_id)
+        self.seq = 0
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def get_delay(self, attempt: int) -> float:
+        return get_backoff(attempt, self.base_delay, self.max_delay)
+
+    def defer(self, doc_id: str) -> bool:
+        """
+        Schedule a retry of the doc, returns False if it is out of attempts.
+        """
+        attempt = self.attempts.get(doc_id, 0) + 1
+        if attempt > self.max_attempts:
+            return False
+        self.attempts[doc_id] = attempt
+        ready_at = time.monotonic() + self.get_delay(attempt)
+        heapq.heappush(self.heap, (ready_at, self.seq, doc_id))
+        self.seq += 1
+        return True
+
+    def wait_time(self) -> float:
+        """
+        Seconds until the next doc is ready.
+        """
+        if not self.heap:
+            return 0.0
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def pop_ready(self) -> list[str]:
+        """
+        Take all docs whose backoff has passed.
+        """
+        now = time.monotonic()
+        ready = []
+        while self.heap and self.heap[0][0] <= now:
+            ready.append(heapq.heappop(self.heap)[2])
+        return ready
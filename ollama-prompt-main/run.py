@@ -3,9 +3,12 @@ import yaml
 import os
 import argparse
 import random
+import sys
 
-from utils import load_env, load_file, save_file
+from utils import get_logger, load_env, load_file, save_file
 from ollama_utils import Annotate
+from pipeline import run_othering_pipeline
+from stage_dag import StageDAG
 
 
 """
@@ -55,10 +58,49 @@ if __name__ == "__main__":
         "--temperature", type=float, help="The temperature for sampling."
     )
     parser.add_argument(
-        "--host", metavar="HOST", required=True, help="The host for the Ollama API."
+        "--host", metavar="HOST", help="The host for the Ollama API."
     )
     parser.add_argument(
-        "--port", metavar="PORT", required=True, help="The port for the Ollama API."
+        "--port", metavar="PORT", help="The port for the Ollama API."
+    )
+    parser.add_argument(
+        "--endpoints",
+        metavar="HOST:PORT",
+        nargs="+",
+        help="Several Ollama servers to spread the requests over, instead of --host/--port.",
+    )
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Docs packed into one request with a list schema (1 = one doc per request).",
+    )
+    parser.add_argument(
+        "--prompt_layout",
+        choices=["flat", "turns"],
+        default="flat",
+        help="Demos glued to each doc in one user turn, or sent as chat turns "
+        "before the doc (a stable prefix the server can cache).",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1,
+        help="Self-consistency: samples per doc with varied seed and temperature, "
+        "majority vote with early stopping (1 = off).",
+    )
+    parser.add_argument(
+        "--sweep",
+        nargs="+",
+        metavar="TEMP[:SEED]",
+        help="Annotate every doc with each temperature (and seed, or 'random') "
+        "in one pass, and vote over them, e.g. --sweep 0.2 0.5 0.9:random.",
+    )
+    parser.add_argument(
+        "--keep_alive",
+        type=str,
+        help="How long Ollama keeps the model loaded, e.g. 30m or -1 for ever.",
     )
 
     # Arguments for parallel processing and saving.
@@ -66,13 +108,94 @@ if __name__ == "__main__":
         "--workers", type=int, help="Number of workers to use for parallel processing."
     )
     parser.add_argument(
-        "--save_interval", type=int, help="The interval at which to save the results."
+        "--save_interval",
+        type=int,
+        help="Docs between fsyncs of the checkpoint log and progress messages.",
+    )
+    parser.add_argument(
+        "--transport_retries",
+        type=int,
+        default=5,
+        help="Times a doc is retried after connection errors, timeouts or server errors.",
+    )
+    parser.add_argument(
+        "--backoff_seconds",
+        type=float,
+        default=2.0,
+        help="Base of the exponential backoff before retrying those docs.",
+    )
+    parser.add_argument(
+        "--resume_attempts",
+        type=int,
+        default=3,
+        help="Max annotation rounds over resumed runs for docs whose annotation failed.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["thread", "async"],
+        default="thread",
+        help="Thread pool of size workers, or async requests with adaptive concurrency.",
+    )
+    parser.add_argument(
+        "--min_concurrency",
+        type=int,
+        default=1,
+        help="Lowest number of requests in flight for the async engine.",
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=32,
+        help="Highest number of requests in flight for the async engine.",
     )
     parser.add_argument(
         "--max_retries",
         type=int,
         default=5,
-        help="Max # of tries for LLM to gen correctly formatted response.",
+        help="Max # of tries for LLM to gen correctly formatted response, asked again right away.",
+    )
+
+    # Arguments for the streaming pipeline.
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Stream the docs through stages 6, 7 and 8 instead of running them one after the other.",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=64,
+        help="Max docs waiting between two pipeline stages.",
+    )
+
+    # Arguments for the stage DAG.
+    parser.add_argument(
+        "--dag",
+        action="store_true",
+        help="Run the stages declared under stages: in the config, skipping the up to date ones.",
+    )
+    parser.add_argument(
+        "--run_stages",
+        nargs="+",
+        help="Stages of the DAG to bring up to date, with the stages they depend on.",
+    )
+
+    # Arguments for the response cache.
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        help="SQLite file of the LLM response cache, defaults to DATA_PATH/cache/.",
+    )
+    parser.add_argument(
+        "--cache_max_mb",
+        type=float,
+        default=1024,
+        help="Max size of the cached responses before the oldest are evicted.",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always query the LLM, don't read or write the response cache.",
     )
 
     # load the environment variables.
@@ -90,11 +213,39 @@ if __name__ == "__main__":
         parser.set_defaults(**config)
         args = parser.parse_args()
 
+    if not args.endpoints and not (args.host and args.port):
+        parser.error("either --host and --port or --endpoints is required.")
+
+    if args.sweep and args.samples > 1:
+        parser.error("--sweep and --samples can't be combined.")
+
+    if not args.cache_path:
+        args.cache_path = os.path.join(DATA_PATH, "cache", "llm_responses.sqlite")
+
     if not args.out_filename:
         args.out_filename = f"stage_1_results_{CURRENT_ITERATION}.json"
 
     original_dataset = args.dataset
 
+    if args.dag:  # the stages declared in the config, instead of the blocks below.
+        dag = StageDAG(
+            args, SCRIPT_PATH, DATA_PATH, RESULT_PATH, CURRENT_ITERATION, get_logger()
+        )
+        dag.run(args.run_stages)
+        sys.exit(0)
+
+    if args.pipeline:  # stages 6 -> 7 -> 8 streamed, instead of the blocks below.
+        run_othering_pipeline(
+            args,
+            SCRIPT_PATH,
+            DATA_PATH,
+            RESULT_PATH,
+            CURRENT_ITERATION,
+            original_dataset,
+            get_logger(),
+        )
+        sys.exit(0)
+
     # #Stage 1
     # annotator_stage_1 = Annotate(
     #     args,
@@ -233,6 +384,7 @@ if __name__ == "__main__":
         stage=7,
         curr_iteration=CURRENT_ITERATION,
         otheringStage=2,
+        dedup=True,  # the docs are target strings, annotate each once.
     )
     annotator_othering.process_docs()
 
@@ -310,6 +462,23 @@ if __name__ == "__main__":
     #     otheringStage=6,
     # )
     # annotator_othering.process_docs()
+
+    # # Othering low, medium and high temp in one pass, with the vote over them
+    # args.sweep = ["0.2", "0.5", f"0.9:{random.randint(0, 2**32 - 1)}"]
+    # args.dataset = stage7_dataset
+    # args.out_filename = f"stage_8_results_{CURRENT_ITERATION}_sweep.json"
+
+    # annotator_othering = Annotate(
+    #     args,
+    #     SCRIPT_PATH,
+    #     os.path.join(DATA_PATH, f"results/{CURRENT_ITERATION}"),
+    #     RESULT_PATH,
+    #     stage=10,
+    #     curr_iteration=CURRENT_ITERATION,
+    #     otheringStage=6,
+    # )
+    # annotator_othering.process_docs()
+    # args.sweep = None
         
         
     args.temperature = 0.2
@@ -27,23 +27,45 @@ export HF_HOME="$SLURM_SCRATCH/cache/HF"
 export PYTHONPATH=/scratch/alpine/niho8409/blast_othering/ollama-prompt-main
 
 unset OLLAMA_ORIGINS
-export OLLAMA_HOST=127.0.0.1:9999
 
+# ONE_SERVER_PER_GPU=1 starts an Ollama server on each GPU (ports 9999, 10000, ...)
+# and spreads the requests over them. Only use it if the model fits on one GPU.
+ONE_SERVER_PER_GPU=${ONE_SERVER_PER_GPU:-0}
+BASE_PORT=9999
 
-echo "Starting up Ollama server"
-nohup ollama serve > ollama_log_annotation.txt 2>&1 &
+if [ "$ONE_SERVER_PER_GPU" = "1" ]; then
+    IFS=',' read -ra GPUS <<< "$CUDA_VISIBLE_DEVICES"
+else
+    GPUS=("${CUDA_VISIBLE_DEVICES:-all}")
+fi
 
-echo "Waiting for Ollama server to start..."
-for i in {1..12}; do
-    if curl -s http://127.0.0.1:9999/api/tags >/dev/null; then
-        echo "✅ Ollama is up"
-        break
-    fi
-    echo "⏳ Waiting ($i/12)..."
-    sleep 10
+ENDPOINTS=()
+for i in "${!GPUS[@]}"; do
+    PORT=$((BASE_PORT + i))
+    echo "Starting up Ollama server on port $PORT (GPUs ${GPUS[$i]})"
+    (
+        if [ "$ONE_SERVER_PER_GPU" = "1" ]; then
+            export CUDA_VISIBLE_DEVICES="${GPUS[$i]}"
+        fi
+        OLLAMA_HOST="127.0.0.1:$PORT" nohup ollama serve > "ollama_log_annotation_$PORT.txt" 2>&1 &
+    )
+    ENDPOINTS+=("127.0.0.1:$PORT")
 done
+export OLLAMA_HOST=127.0.0.1:$BASE_PORT
 
-ss -tlnp | grep 9999 || echo "⚠️ Ollama not listening yet"
+for ENDPOINT in "${ENDPOINTS[@]}"; do
+    echo "Waiting for Ollama server $ENDPOINT to start..."
+    for i in {1..12}; do
+        if curl -s "http://$ENDPOINT/api/tags" >/dev/null; then
+            echo "✅ Ollama is up"
+            break
+        fi
+        echo "⏳ Waiting ($i/12)..."
+        sleep 10
+    done
+done
+
+ss -tlnp | grep $BASE_PORT || echo "⚠️ Ollama not listening yet"
 
 echo "Running annotation script"
-python3 -m ollama-prompt-main.run --host 127.0.0.1 --port 9999 --config default.yaml
\ No newline at end of file
+python3 -m ollama-prompt-main.run --endpoints "${ENDPOINTS[@]}" --config default.yaml
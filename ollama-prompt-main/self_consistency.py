@@ -0,0 +1,118 @@
+import random
+import statistics
+from collections import Counter
+
+"""
+Self-consistency voting: a doc is annotated several times with different
+seeds and temperatures and the majority label wins. Samples are sent in
+waves, each just big enough that it could decide the vote, and no more
+samples are sent once a label has a majority the remaining samples
+can't beat. A temperature sweep sends a fixed list of variants of each
+doc in one pass and votes over all of them.
+"""
+
+# each sample raises the temperature by this much and the seed by 1.
+TEMPERATURE_STEP = 0.05
+
+
+def get_sample_options(options: dict, sample: int) -> dict:
+    """
+    Request options of sample number sample (from 0), without touching
+    the shared options of the client.
+    """
+    base_temp = options.get("temperature")
+    if base_temp is None:
+        base_temp = 0.7
+    base_seed = options.get("seed")
+    if base_seed is None:
+        base_seed = 42
+    return {
+        **options,
+        "temperature": base_temp + TEMPERATURE_STEP * sample,
+        "seed": base_seed + sample,
+    }
+
+
+def parse_variant(value, default_seed: int) -> dict:
+    """
+    Options of a sweep variant given as "TEMP[:SEED]", e.g. "0.2",
+    "0.9:7" or "0.9:random" for a seed drawn once per run.
+    """
+    temperature, _, seed = str(value).partition(":")
+    if not seed:
+        seed = default_seed
+    elif seed == "random":
+        seed = random.randint(0, 2**32 - 1)
+    return {"temperature": float(temperature), "seed": int(seed)}
+
+
+class SelfConsistencyVote:
+    """
+    Class to count the votes of the samples of one doc.
+        - vote_field is the answer field voted on, e.g. "label".
+        - samples whose answer is invalid count as used, without a vote.
+    """
+
+    def __init__(self, n_samples: int, vote_field: str = "label"):
+        self.n_samples = n_samples
+        self.vote_field = vote_field
+        self.answers = []
+        self.votes = []
+        self.counts = Counter()
+        self.used = 0
+
+    @staticmethod
+    def normalize(value) -> str:
+        return str(value).strip().lower()
+
+    def add(self, answer: dict):
+        self.used += 1
+        if answer is None or self.vote_field not in answer:
+            return
+        vote = self.normalize(answer[self.vote_field])
+        self.answers.append(answer)
+        self.votes.append(vote)
+        self.counts[vote] += 1
+
+    def get_margin(self) -> int:
+        """
+        Lead of the top label over the runner-up.
+        """
+        top = self.counts.most_common(2) + [(None, 0), (None, 0)]
+        return top[0][1] - top[1][1]
+
+    def is_decided(self) -> bool:
+        """
+        No samples are left, or the runner-up can't catch up even if it
+        gets all of them.
+        """
+        remaining = self.n_samples - self.used
+        return remaining == 0 or self.get_margin() > remaining
+
+    def get_wave_size(self) -> int:
+        """
+        Fewest samples that could decide the vote if they all agree
+        with the top label.
+        """
+        if self.is_decided():
+            return 0
+        remaining = self.n_samples - self.used
+        return min(remaining, (remaining - self.get_margin()) // 2 + 1)
+
+    def result(self) -> dict:
+        """
+        The first answer with the majority label, plus the votes, the
+        share of them for the majority, the averaged score of all samples
+        and the number of samples used. None if no sample gave a valid answer.
+        """
+        if not self.votes:
+            return None
+        final_vote, count = self.counts.most_common(1)[0]
+        answer = dict(self.answers[self.votes.index(final_vote)])
+
+        scores = [a["score"] for a in self.answers if a.get("score") is not None]
+        answer["votes"] = self.votes
+        answer["agreement"] = round(count / len(self.votes), 2)
+        answer["avg_score"] = statistics.mean(scores) if scores else None
+        answer["samples"] = self.used
+        return answer
@@ -0,0 +1,317 @@
+import copy
+import hashlib
+import json
+import os
+
+from ollama_utils import Annotate, OllamaClient
+from resume_index import ResumeIndex
+from utils import load_file, save_file
+
+"""
+Run the annotation stages declared under stages: in the config as a DAG,
+instead of the commented-out blocks of run.py. Each stage names its prompt
+file, answer schema, input (the dataset or an upstream stage plus a filter)
+and options. A stage's output is fingerprinted by its input data, prompt,
+model and options, and the stage is skipped while the fingerprint is
+unchanged, so after a prompt edit only that stage and the stages that get
+different inputs from it are recomputed.
+"""
+
+
+def label_filter(label: str):
+    """
+    Keep the docs annotated with label, e.g. "hate" after stage 1.
+    """
+
+    def keep(doc_id, doc, original_data):
+        annotation = doc.get("annotation")
+        if (
+            isinstance(annotation, dict)
+            and str(annotation.get("label", "")).lower() == label
+        ):
+            return {"text": doc["text"]}
+        return None
+
+    return keep
+
+
+def get_target(doc_id, doc, original_data):
+    """
+    The target identified in stage 6, as a doc of its own.
+    """
+    annotation = doc.get("annotation")
+    if isinstance(annotation, dict) and "target" in annotation:
+        return {"text": annotation["target"]}
+    return None
+
+
+def get_social_group_case(doc_id, doc, original_data):
+    """
+    The original text of docs whose target is a social group (stage 7).
+    """
+    annotation = doc.get("annotation")
+    if (
+        isinstance(annotation, dict)
+        and annotation.get("isSocialGroup") in [True, "True", "true"]
+        and doc_id in original_data
+    ):
+        return {"text": original_data[doc_id]["text"]}
+    return None
+
+
+# filters turning an annotated doc into the input of the next stage.
+FILTERS = {
+    "hate": label_filter("hate"),
+    "other": label_filter("other"),
+    "target": get_target,
+    "is_social_group": get_social_group_case,
+}
+
+# run arguments a stage may override.
+STAGE_OPTIONS = [
+    "model",
+    "seed",
+    "temperature",
+    "batch_size",
+    "prompt_layout",
+    "samples",
+    "sweep",
+]
+
+
+class StageDAG:
+    """
+    Class to run the stages of the config in dependency order.
+        - a stage's input is "dataset" (the original dataset) or the name
+          of an upstream stage, whose results go through filter.
+        - the fingerprint of a stage is written next to its results before
+          it runs. A stage is skipped if the fingerprint matches and the
+          resume index has no docs pending. If it changed, the old outputs
+          are moved to <file>.stale and the stage is recomputed.
+        - results of runs from before fingerprints are adopted, i.e.
+          resumed through the resume index.
+    """
+
+    def __init__(
+        self, args, script_path, data_path, results_path, curr_iteration, logger
+    ):
+        self.args = args
+        self.script_path = script_path
+        self.data_path = data_path
+        self.results_path = results_path
+        self.curr_iteration = curr_iteration
+        self.logger = logger
+
+        self.stages = args.stages or {}
+        for name, spec in self.stages.items():
+            source = spec.get("input", "dataset")
+            if source != "dataset" and source not in self.stages:
+                raise ValueError(f"Stage {name}: unknown input {source}.")
+            if source != "dataset" and spec.get("filter") not in FILTERS:
+                raise ValueError(
+                    f"Stage {name}: filter must be one of {list(FILTERS)}."
+                )
+            if "prompt_file" not in spec or "out_filename" not in spec:
+                raise ValueError(f"Stage {name}: prompt_file and out_filename are required.")
+
+        self.original_data = None
+        self.results = {}  # stage name -> {doc_id: annotated doc}
+
+    def get_order(self, targets: list[str]) -> list[str]:
+        """
+        The target stages and everything upstream of them, upstream first.
+        """
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}.")
+            if name in visiting:
+                raise ValueError(f"Stage {name} depends on itself.")
+            visiting.add(name)
+            source = self.stages[name].get("input", "dataset")
+            if source != "dataset":
+                visit(source)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in targets:
+            visit(name)
+        return order
+
+    def get_stage_args(self, name: str):
+        """
+        The run arguments with the stage's options and file names.
+        """
+        spec = self.stages[name]
+        stage_args = copy.copy(self.args)
+        for option in STAGE_OPTIONS:
+            if option in spec:
+                setattr(stage_args, option, spec[option])
+        stage_args.out_filename = spec["out_filename"].format(
+            iteration=self.curr_iteration
+        )
+        return stage_args
+
+    def get_inputs(self, name: str) -> dict:
+        """
+        The docs a stage annotates.
+        """
+        if self.original_data is None:
+            self.original_data = load_file(
+                os.path.join(self.data_path, self.args.dataset), logger=self.logger
+            )
+
+        spec = self.stages[name]
+        source = spec.get("input", "dataset")
+        if source == "dataset":
+            return self.original_data
+
+        keep = FILTERS[spec["filter"]]
+        docs = {}
+        for doc_id, doc in self.results[source].items():
+            next_doc = keep(doc_id, doc, self.original_data)
+            if next_doc is not None:
+                docs[doc_id] = next_doc
+        return docs
+
+    @staticmethod
+    def get_hash(data) -> str:
+        data = json.dumps(data, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get_fingerprint(self, name: str, stage_args, docs: dict) -> dict:
+        """
+        Hashes of everything the output of a stage depends on.
+        """
+        spec = self.stages[name]
+        with open(os.path.join(self.script_path, spec["prompt_file"]), "rb") as f:
+            prompt_hash = hashlib.sha256(f.read()).hexdigest()
+        schema = getattr(OllamaClient, spec.get("answer_schema", "Answer"))
+
+        parts = {
+            "input": self.get_hash(docs),
+            "prompt": prompt_hash,
+            "schema": self.get_hash(schema.model_json_schema()),
+            "model": stage_args.model,
+            "options": self.get_hash(
+                {
+                    "seed": stage_args.seed,
+                    "temperature": stage_args.temperature,
+                    "batch_size": stage_args.batch_size,
+                    "prompt_layout": stage_args.prompt_layout,
+                    "samples": stage_args.samples,
+                    "sweep": stage_args.sweep,
+                    "dedup": spec.get("dedup", False),
+                }
+            ),
+        }
+        return {"fingerprint": self.get_hash(parts), "parts": parts}
+
+    def get_output_paths(self, stage_args) -> dict:
+        out_name = os.path.splitext(stage_args.out_filename)[0]
+        return {
+            "results": os.path.join(self.results_path, stage_args.out_filename),
+            "index": os.path.join(self.results_path, f"{out_name}.index.json"),
+            "log": os.path.join(self.results_path, f"{out_name}.log.jsonl"),
+            "fingerprint": os.path.join(
+                self.results_path, f"{out_name}.fingerprint.json"
+            ),
+        }
+
+    def is_complete(self, paths: dict, docs: dict) -> bool:
+        """
+        Whether every input doc is done or out of attempts.
+        """
+        if not os.path.exists(paths["results"]) or os.path.exists(paths["log"]):
+            return False
+        index = ResumeIndex(paths["index"])
+        if not index.load():
+            return False
+        return not any(
+            index.is_pending(doc_id, self.args.resume_attempts) for doc_id in docs
+        )
+
+    def move_stale(self, name: str, paths: dict):
+        """
+        Move the outputs of an outdated stage out of the way, so none of
+        them are resumed.
+        """
+        for path in paths.values():
+            if os.path.exists(path):
+                os.replace(path, f"{path}.stale")
+        self.logger.info(f"Stage {name}: moved outdated outputs to *.stale.")
+
+    def run_stage(self, name: str):
+        spec = self.stages[name]
+        stage_args = self.get_stage_args(name)
+        docs = self.get_inputs(name)
+        if spec.get("data_filename"):  # the inputs, like the stage_<N>_data files.
+            data_filename = spec["data_filename"].format(iteration=self.curr_iteration)
+            save_file(docs, self.results_path, data_filename, logger=self.logger)
+
+        paths = self.get_output_paths(stage_args)
+        fingerprint = self.get_fingerprint(name, stage_args, docs)
+        previous = None
+        if os.path.exists(paths["fingerprint"]):
+            previous = load_file(paths["fingerprint"], logger=self.logger)
+
+        if previous is None:
+            if os.path.exists(paths["results"]):
+                self.logger.info(f"Stage {name}: no fingerprint, resuming existing results.")
+        elif previous["fingerprint"] == fingerprint["fingerprint"]:
+            if self.is_complete(paths, docs):
+                self.logger.info(f"Stage {name}: unchanged, skipped.")
+                self.results[name] = self.load_results(paths, docs)
+                return
+        else:
+            changed = [
+                part
+                for part, value in fingerprint["parts"].items()
+                if previous["parts"].get(part) != value
+            ]
+            self.logger.info(f"Stage {name}: {', '.join(changed)} changed, recomputing.")
+            self.move_stale(name, paths)
+
+        # written first, so an interrupted run resumes instead of restarting.
+        save_file(
+            fingerprint,
+            self.results_path,
+            os.path.basename(paths["fingerprint"]),
+            logger=self.logger,
+        )
+        annotator = Annotate(
+            stage_args,
+            self.script_path,
+            self.data_path,
+            self.results_path,
+            logger=self.logger,
+            curr_iteration=self.curr_iteration,
+            dedup=spec.get("dedup", False),
+            docs=docs,
+            prompt_file=spec["prompt_file"],
+            answer_schema=spec.get("answer_schema", "Answer"),
+        )
+        annotator.process_docs()
+        self.results[name] = self.load_results(paths, docs)
+
+    def load_results(self, paths: dict, docs: dict) -> dict:
+        """
+        The annotated input docs of a stage.
+        """
+        data = {}
+        if os.path.exists(paths["results"]):
+            data = load_file(paths["results"], logger=self.logger).get("data", {})
+        return {doc_id: data[doc_id] for doc_id in docs if doc_id in data}
+
+    def run(self, targets: list[str]):
+        """
+        Bring the target stages up to date.
+        """
+        order = self.get_order(targets)
+        self.logger.info(f"Stage DAG: {' -> '.join(order)}.")
+        for name in order:
+            self.run_stage(name)
@@ -0,0 +1,84 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("convokit")
+
+import DatasetCreation
+
+"""
+Checks that scanning a corpus in windows emits every target once, with a
+stand-in for convokit's Corpus that, like convokit, treats
+utterance_end_index as inclusive.
+"""
+
+N_UTTERANCES = 20
+
+
+def make_utterances():
+    utterances = []
+    for i in range(N_UTTERANCES):
+        utterances.append(
+            SimpleNamespace(
+                id=f"u{i}",
+                # every other utterance is a target, chains of three.
+                text="they are vermin" if i % 2 else "a normal reply",
+                reply_to=f"u{i - 1}" if i % 3 else None,
+                timestamp=i,
+                conversation_id=f"u{i - i % 3}",
+            )
+        )
+    return utterances
+
+
+class InclusiveCorpus:
+    """
+    Class to serve a slice of the synthetic utterances like convokit:
+    start_index <= idx <= end_index.
+    """
+
+    def __init__(self, filename, backend, utterance_start_index, utterance_end_index):
+        selected = make_utterances()[utterance_start_index : utterance_end_index + 1]
+        self.utterances = {utt.id: utt for utt in selected}
+
+    def iter_utterances(self):
+        return iter(self.utterances.values())
+
+    def get_utterance(self, utt_id):
+        return self.utterances[utt_id]
+
+
+@pytest.fixture
+def fake_corpus(monkeypatch):
+    monkeypatch.setattr(DatasetCreation, "Corpus", InclusiveCorpus)
+    monkeypatch.setattr(DatasetCreation, "download", lambda name: name)
+
+
+@pytest.mark.parametrize("end_index", [N_UTTERANCES, None])
+def test_windows_emit_each_target_once(fake_corpus, tmp_path, end_index):
+    expected = {utt.id for utt in make_utterances() if utt.text == "they are vermin"}
+
+    out = tmp_path / "targets.jsonl"
+    count = DatasetCreation.scan_corpus_parallel(
+        "fake", str(out), end_index=end_index, window_size=3, workers=2
+    )
+    records = [
+        entry["id"]
+        for entry in map(json.loads, out.read_text().splitlines())
+        if entry["type"] == "record"
+    ]
+    assert count == len(records)
+    assert sorted(records) == sorted(expected)
+
+    out = tmp_path / "targets.json"
+    DatasetCreation.scan_corpus_parallel(
+        "fake",
+        str(out),
+        end_index=end_index,
+        window_size=3,
+        workers=2,
+        output_format="dataset",
+    )
+    keys = json.loads(out.read_text(), object_pairs_hook=lambda pairs: [k for k, _ in pairs])
+    assert sorted(keys) == sorted(expected)